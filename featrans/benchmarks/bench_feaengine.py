@@ -0,0 +1,153 @@
+# coding: utf-8
+"""
+Benchmark FeaEngine on synthetic data.
+
+Usage(from the featrans directory):
+PYTHONPATH=.. python -m benchmarks.bench_feaengine --rows 10000 100000 --output bench.json
+
+Each run generates a DataFrame with label, numeric, text and category columns whose terms follow
+a Zipf distribution, then measures load, transform, save_engine, load_engine, transform on engines
+loaded from snapshots and feature_name.
+Times are measured in one pass, peak memory(by tracemalloc) in another pass with --memory, since
+tracing slows everything down.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+import pandas
+
+from featrans.feaengine import FeaEngine
+
+
+def generate(num_rows, num_columns, text_columns, category_columns, vocab_size, terms_per_row, zipf, seed):
+    """Return (DataFrame, transformer settings) of synthetic data.
+    """
+    rng = numpy.random.default_rng(seed)
+    probs = 1.0 / numpy.arange(1, vocab_size + 1) ** zipf
+    probs /= probs.sum()
+    vocab = numpy.array(["t{}".format(i) for i in range(vocab_size)], dtype=object)
+
+    data = {"label": numpy.where(rng.random(num_rows) < 0.5, "1", "0")}
+    settings = [("label", "label")]
+    for i in range(num_columns):
+        name = "num{}".format(i)
+        values = numpy.round(rng.normal(size=num_rows), 4).astype(str).astype(object)
+        values[rng.random(num_rows) < 0.1] = ""
+        data[name] = values
+        settings.append((name, "num", "min_max", 0.0))
+    for i in range(text_columns):
+        name = "text{}".format(i)
+        lengths = rng.poisson(terms_per_row, size=num_rows)
+        terms = vocab[rng.choice(vocab_size, size=lengths.sum(), p=probs)]
+        ends = numpy.cumsum(lengths)
+        data[name] = [",".join(terms[end - length:end]) for length, end in zip(lengths, ends)]
+        settings.append((name, "text", "min_max", ","))
+    for i in range(category_columns):
+        name = "category{}".format(i)
+        data[name] = vocab[rng.choice(vocab_size, size=num_rows, p=probs)]
+        settings.append((name, "category"))
+    return pandas.DataFrame(data), settings
+
+
+def run_stages(df, settings, workdir, trace):
+    """Run every stage once, return {stage: {"seconds": ..., "items_per_second": ...}} and
+    "engine_bytes" for size of the pickled engine. Stages also get "peak_bytes" if trace.
+    """
+    results = dict()
+
+    def measure(stage, fn, items):
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - start
+        result = {"seconds": seconds, "items_per_second": items / seconds if seconds > 0 else None}
+        if trace:
+            result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[stage] = result
+
+    num_rows = len(df)
+    engine = FeaEngine()
+    engine.update_engine(settings, 0, list(df.columns))
+    measure("load", lambda: engine.load(df), num_rows)
+    engine.clear_cache()
+    measure("transform", lambda: sum(1 for _ in engine.transform(df)), num_rows)
+    engine.clear_cache()
+    measure("transform_matrix", lambda: engine.transform_matrix(df), num_rows)
+
+    pickle_file = os.path.join(workdir, "engine.pkl")
+    snapshot_dir = os.path.join(workdir, "engine.snapshot")
+    measure("save_engine", lambda: engine.save_engine(pickle_file), 1)
+    measure("save_engine_snapshot", lambda: engine.save_engine(snapshot_dir, format="snapshot"), 1)
+    measure("load_engine", lambda: FeaEngine().load_engine(pickle_file), 1)
+    measure("load_engine_mmap", lambda: FeaEngine().load_engine(snapshot_dir, mmap=True), 1)
+    results["engine_bytes"] = os.path.getsize(pickle_file)
+
+    for stage, mmap in (("transform_snapshot", False), ("transform_snapshot_mmap", True)):
+        loaded = FeaEngine()
+        loaded.load_engine(snapshot_dir, mmap=mmap)
+        loaded.update_index_from(engine.index_from).update_columns(engine.columns)
+        measure(stage, lambda: sum(1 for _ in loaded.transform(df)), num_rows)
+
+    num_features = engine.index_from + sum(t.width for t in engine.transformers.values() if hasattr(t, "width"))
+    measure("feature_name", lambda: [engine.feature_name(i) for i in range(num_features)], num_features)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000], help="row counts to run")
+    parser.add_argument("--num-columns", type=int, default=2)
+    parser.add_argument("--text-columns", type=int, default=1)
+    parser.add_argument("--category-columns", type=int, default=1)
+    parser.add_argument("--vocab-size", type=int, default=100000)
+    parser.add_argument("--terms-per-row", type=float, default=10)
+    parser.add_argument("--zipf", type=float, default=1.1, help="exponent of term frequencies")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--memory", action="store_true", help="also measure peak memory")
+    parser.add_argument("--output", help="json file to write, default to stdout")
+    args = parser.parse_args(argv)
+
+    report = {"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": sys.version.split()[0], "params": vars(args), "runs": []}
+    workdir = tempfile.mkdtemp(prefix="bench_featrans_")
+    try:
+        for num_rows in args.rows:
+            df, settings = generate(num_rows, args.num_columns, args.text_columns, args.category_columns,
+                                    args.vocab_size, args.terms_per_row, args.zipf, args.seed)
+            stages = run_stages(df, settings, workdir, False)
+            run = {"rows": num_rows, "engine_bytes": stages.pop("engine_bytes"), "stages": stages}
+            if args.memory:
+                memory = run_stages(df, settings, workdir, True)
+                for stage, result in stages.items():
+                    result["peak_bytes"] = memory[stage]["peak_bytes"]
+            report["runs"].append(run)
+    finally:
+        shutil.rmtree(workdir)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fout:
+            fout.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
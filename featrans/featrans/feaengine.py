@@ -1,13 +1,97 @@
 #coding: utf-8
+import gzip
 import logging
+import math
+import os
 import time
 import _pickle as pickle
+import numpy
+
+from utils.log import get_logger
+from utils.multiprocess import parallel_imap
 
 from .transformer import *
 from .normalizer import *
+from .snapshot import save_snapshot, load_snapshot
+from .instrument import ColumnStats
 
 logger = logging.getLogger(__name__)
 
+# Engine shipped to each worker process of a pool once.
+_worker_engine = None
+
+
+def _init_worker(engine):
+    global _worker_engine
+    _worker_engine = engine
+
+
+def _run_chunk(args):
+    fn, chunk = args
+    return fn(_worker_engine, chunk)
+
+
+def _transform_chunk(engine, chunk):
+    return list(engine.transform(chunk))
+
+
+def format_svmlight(label, features):
+    """Format one transformed row as a svmlight line 'label idx:value idx:value' without newline.
+    """
+    return " ".join([str(label)] + ["{}:{}".format(idx, value) for idx, value in features])
+
+
+def _format_chunk(engine, chunk):
+    lines = [format_svmlight(label, features) for label, features in engine.transform(chunk)]
+    lines.append("")
+    return len(lines) - 1, "\n".join(lines).encode("utf-8")
+
+
+def _iter_chunks(df_or_chunks, chunksize):
+    """Split a DataFrame into chunks of chunksize rows, or pass an iterable of DataFrames through.
+    """
+    if hasattr(df_or_chunks, "iloc"):
+        for start in range(0, len(df_or_chunks), chunksize):
+            yield df_or_chunks.iloc[start:start + chunksize]
+    else:
+        for chunk in df_or_chunks:
+            yield chunk
+
+
+class TransformPlan(object):
+    """Transform rows of dict with column order, offsets and transform functions of an engine
+    precomputed. Compile a new plan after the engine changes.
+    """
+    def __init__(self, label_column, label_transform, columns):
+        self.label_column = label_column
+        self.label_transform = label_transform
+        # List of (column_name, transform, index_from).
+        self.columns = columns
+
+    def transform_one(self, row):
+        """Return (label, indices, values) of a dict row, label is None if the row has no label column,
+        e.g. online requests.
+        """
+        label = None
+        if self.label_column is not None and self.label_column in row:
+            label = self.label_transform(row[self.label_column])
+        indices = []
+        values = []
+        for column_name, transform, index_from in self.columns:
+            for idx, value in transform(row[column_name]):
+                indices.append(idx + index_from)
+                values.append(value)
+        return label, indices, values
+
+    def __call__(self, rows):
+        """Transform a dict row, or a list of dict rows into a list of results.
+        """
+        if isinstance(rows, list):
+            transform_one = self.transform_one
+            return [transform_one(row) for row in rows]
+        return self.transform_one(rows)
+
+
 class FeaEngine(object):
     def __init__(self):
         self.transformers = None
@@ -15,7 +99,14 @@ class FeaEngine(object):
         self.columns = None
 
         self.idx2feaname = dict()
+        self.hashed_ranges = []
         self.feaname_updated = False
+
+        # Column name -> ColumnStats, None if instrumentation is disabled.
+        self.instruments = None
+        self.report_callback = None
+        self.report_interval = None
+        self.next_report = None
     
     def update_engine(self, transformers, index_from, columns):
         """Update the whole engine.
@@ -29,41 +120,137 @@ class FeaEngine(object):
     def update_transformers(self, transformers):
         if transformers:
             self.__set_transformers(transformers)
+            self.feaname_updated = False
         return self
         
     def update_index_from(self, index_from):
         if index_from is not None:
             self.index_from = index_from
+            self.feaname_updated = False
         return self
 
     def update_columns(self, columns):
         if columns:
             self.columns = columns
+            self.feaname_updated = False
         return self
         
     def __update_feaname(self):
         idx2feaname = dict()
+        hashed_ranges = []
         index_from = self.index_from
         for column_name in self.columns:
             transformer = self.transformers[column_name]
             if isinstance(transformer, LabelTransformer):
                 continue
-            for feaname, idx in transformer.fea2idx.items():
-                idx2feaname[idx + index_from] = "{}-{}".format(column_name, feaname)
-            index_from += transformer.num_features
+            if isinstance(transformer, HashingTransformer):
+                hashed_ranges.append((index_from, index_from + transformer.width, column_name))
+            else:
+                for feaname, idx in transformer.fea2idx.items():
+                    idx2feaname[idx + index_from] = "{}-{}".format(column_name, feaname)
+            index_from += transformer.width
         self.idx2feaname = idx2feaname
+        self.hashed_ranges = hashed_ranges
         self.feaname_updated = True
 
-    def save_engine(self, save_to):
-        with open(save_to, "wb") as fout:
-            pickle.dump(self.transformers, fout)
+    def save_engine(self, save_to, format="pickle"):
+        """Save transformers to save_to.
+        Params:
+        format: "pickle" for a single pickle file, "snapshot" for a directory of arrays which
+            load_engine can memory map.
+        """
+        if format == "pickle":
+            with open(save_to, "wb") as fout:
+                pickle.dump(self.transformers, fout)
+        elif format == "snapshot":
+            save_snapshot(self.transformers, save_to)
+        else:
+            raise ValueError("Unsupported engine format {}. Supported formats are: pickle, snapshot.".format(format))
+
+    def load_engine(self, filename, mmap=False):
+        """Load transformers saved by save_engine, snapshot arrays are memory mapped if mmap.
+        """
+        self.clear_cache()
+        if os.path.isdir(filename):
+            self.transformers = load_snapshot(filename, mmap)
+        else:
+            with open(filename, "rb") as fin:
+                self.transformers = pickle.load(fin)
+        self.feaname_updated = False
+        self.__reset_instruments()
+
+    def enable_stats(self, interval=None, callback=None, log_path=None):
+        """Record per column time, rows processed, non-zero features emitted and cache hit rate,
+        see stats. Stats of transform_parallel workers are not collected.
+        Params:
+        interval: report stats every interval seconds while loading or transforming.
+        callback: called with stats() to report, default to log them, to log_path if given.
+        """
+        self.instruments = dict()
+        self.report_interval = interval
+        if interval is not None and callback is None:
+            stats_logger = get_logger(__name__ + ".stats", log_path)
+            callback = lambda stats: stats_logger.info("%s", stats)
+        self.report_callback = callback
+        self.next_report = time.monotonic() + interval if interval is not None else None
+        return self
+
+    def disable_stats(self):
+        self.instruments = None
+        self.report_callback = None
+        self.report_interval = None
+        self.next_report = None
+        return self
+
+    def __reset_instruments(self):
+        if self.instruments is not None:
+            self.instruments = dict()
+
+    def __instrument(self, column_name):
+        instrument = self.instruments.get(column_name)
+        if instrument is None:
+            instrument = self.instruments[column_name] = ColumnStats(self.transformers[column_name])
+        return instrument
+
+    def __maybe_report(self):
+        if self.next_report is not None and time.monotonic() >= self.next_report:
+            self.next_report = time.monotonic() + self.report_interval
+            self.report_callback(self.stats())
+
+    def stats(self):
+        """Return {column: stats} with memoization cache hits, misses and hit_rate of each column,
+        plus transform_seconds, rows, nnz, load_seconds and loaded_rows recorded if stats are enabled.
+        """
+        stats = dict()
+        for column_name, info in self.cache_info().items():
+            column_stats = dict()
+            if info is not None:
+                lookups = info.hits + info.misses
+                column_stats.update(cache_hits=info.hits, cache_misses=info.misses,
+                                    cache_hit_rate=info.hits / lookups if lookups else None)
+            if self.instruments is not None and column_name in self.instruments:
+                column_stats.update(self.instruments[column_name].summary())
+            stats[column_name] = column_stats
+        return stats
 
-    def load_engine(self, filename):
-        with open(filename, "rb") as fin:
-            self.transformers = pickle.load(fin)
+    def clear_cache(self):
+        """Drop memoized transform results of all transformers.
+        """
+        if self.transformers:
+            for transformer in self.transformers.values():
+                transformer.clear_cache()
+
+    def cache_info(self):
+        """Return memoization statistics(hits, misses, evictions, currsize, maxsize) of each column.
+        """
+        if not self.transformers:
+            return dict()
+        return {column_name: transformer.cache_info() for column_name, transformer in self.transformers.items()}
 
     def __set_transformers(self, params):
         """Create transformers for each column defined in params.
+        text, text_hash and category settings take an optional dict of keyword options at last,
+        e.g. ("title", "text", "min_max", ",", {"min_df": 2, "max_features": 100000, "ngram": 2}).
         """
         transformers = dict()
         for param in params:
@@ -78,13 +265,25 @@ class FeaEngine(object):
             elif param[1] == "text":
                 norm_type = param[2]
                 sep = param[3]
+                options = param[4] if len(param) > 4 else {}
                 norm = create_normalizer(norm_type)
-                transformers[column_name] = TextTransformer(norm, sep)
+                transformers[column_name] = TextTransformer(norm, sep, **options)
             elif param[1] == "category":
-                transformers[column_name] = CategoryTransformer()
+                options = param[2] if len(param) > 2 else {}
+                transformers[column_name] = CategoryTransformer(**options)
+            elif param[1] == "text_hash":
+                sep = param[2]
+                n_features = int(param[3])
+                options = param[4] if len(param) > 4 else {}
+                transformers[column_name] = HashingTextTransformer(sep, n_features, **options)
+            elif param[1] == "category_hash":
+                n_features = int(param[2])
+                transformers[column_name] = HashingCategoryTransformer(n_features)
             else:
-                raise ValueError("Unsupported transformer type {}. Supported types are: label, num, text, category.".format(param[1]))
+                raise ValueError("Unsupported transformer type {}. Supported types are: label, num, text, category, text_hash, category_hash.".format(param[1]))
+        self.clear_cache()
         self.transformers = transformers
+        self.__reset_instruments()
 
     def set_normalizer(self, column_name, normalizer):
         if column_name not in self.transformers:
@@ -96,15 +295,79 @@ class FeaEngine(object):
     def load(self, df):
         """Load data of pandas format to prepare transformers.
         """
+        self.load_stream([df])
+
+    def load_stream(self, chunks):
+        """Load data from an iterable of pandas DataFrames to prepare transformers,
+        e.g. pandas.read_csv(filename, chunksize=100000).
+        Features and statistics are accumulated chunk by chunk, the result is the same as
+        loading all chunks concatenated at once.
+        """
+        feanames = None
+        for chunk in chunks:
+            if feanames is None:
+                feanames = []
+                for feaname in chunk:
+                    transformer = self.transformers.get(feaname, None)
+                    if not transformer or isinstance(transformer, LabelTransformer):
+                        continue
+                    transformer.reset()
+                    feanames.append(feaname)
+            for feaname in feanames:
+                if self.instruments is None:
+                    self.transformers[feaname].update(chunk[feaname])
+                else:
+                    self.__instrument(feaname).update(chunk[feaname])
+            self.__maybe_report()
+
         fea_count = 0
+        for feaname in feanames or []:
+            transformer = self.transformers[feaname]
+            transformer.fit()
+            fea_count += transformer.num_features
+            logger.info("Load %d features for column %s", transformer.num_features, feaname)
+            if self.instruments is not None:
+                stats = self.__instrument(feaname).summary()
+                logger.info("Column %s: %d samples loaded in %.3fs", feaname, stats["loaded_rows"], stats["load_seconds"])
+        self.feaname_updated = False
+        logger.info("%d features loaded.", fea_count)
+
+    def update(self, df, prune=False):
+        """Refresh loaded transformers with new data of pandas format incrementally.
+        New terms get indices after existing ones and statistics are merged, so indices of
+        known features never change. Call reserve before to keep column offsets stable too.
+        Samples counted for min_df add up across updates of transformers with keep_sketch.
+        Params:
+        prune: apply max_df and max_features of transformers again, which drops and renumbers features.
+        """
         for feaname in df:
             transformer = self.transformers.get(feaname, None)
             if not transformer or isinstance(transformer, LabelTransformer):
                 continue
-            transformer.load(df[feaname])
-            fea_count += transformer.num_features
-            logger.info("Load %d features for column %s", transformer.num_features, feaname)
-        logger.info("%d features loaded.", fea_count)
+            num_features = transformer.num_features
+            transformer.update(df[feaname])
+            transformer.fit(prune=prune)
+            logger.info("Add %d features for column %s", transformer.num_features - num_features, feaname)
+            if transformer.capacity is not None and transformer.num_features >= transformer.capacity:
+                logger.warning("Column %s is full with %d features, new terms are ignored.", feaname, transformer.capacity)
+        self.feaname_updated = False
+
+    def reserve(self, headroom, columns=None):
+        """Reserve indices for new terms of vocabulary columns, so offsets of the following columns stay
+        the same across update.
+        Params:
+        headroom: number of extra indices if int, a fraction of current features if float.
+        columns: columns to reserve for, default to all vocabulary columns.
+        """
+        for column_name, transformer in self.transformers.items():
+            if columns is not None and column_name not in columns:
+                continue
+            if not isinstance(transformer, VocabTransformer):
+                continue
+            extra = int(math.ceil(transformer.num_features * headroom)) if isinstance(headroom, float) else headroom
+            transformer.capacity = transformer.num_features + extra
+        self.feaname_updated = False
+        return self
 
     def transform_row(self, row):
         label = None
@@ -114,27 +377,46 @@ class FeaEngine(object):
         for column_name in self.columns:
             transformer = self.transformers[column_name]
             text = row[column_name]
+            transform = transformer.transform if self.instruments is None else self.__instrument(column_name)
             if isinstance(transformer, LabelTransformer):
-                label = transformer.transform(text)
+                label = transform(text)
             else:
                 reindexed = []
-                for idx, value in transformer.transform(text):
+                for idx, value in transform(text):
                     reindexed.append((idx + index_from, value))
                 features.extend(reindexed)
-                index_from += transformer.num_features
+                index_from += transformer.width
         return label, features
     
+    def compile(self):
+        """Return a TransformPlan to transform single dict rows with little overhead, for online serving.
+        """
+        self.__check_valid()
+        label_column = None
+        label_transform = None
+        columns = []
+        index_from = self.index_from
+        for column_name in self.columns:
+            if column_name not in self.transformers:
+                raise ValueError("No transformer found for column: {}.".format(column_name))
+            transformer = self.transformers[column_name]
+            transform = transformer.transform if self.instruments is None else self.__instrument(column_name)
+            if isinstance(transformer, LabelTransformer):
+                label_column, label_transform = column_name, transform
+            else:
+                columns.append((column_name, transform, index_from))
+                index_from += transformer.width
+        return TransformPlan(label_column, label_transform, columns)
+
     def __check_valid(self):
         if not self.columns:
             raise ValueError("Must call 'update_columns' first to set needed label and feature columns.")
         if not self.transformers:
             raise ValueError("Must call 'update_transformers' first to set tranformers.")
-        if not self.index_from:
+        if self.index_from is None:
             raise ValueError("Must call 'update_index' first to set init index.")
 
-    def transform(self, df):
-        """Transform features for given columns.
-        """
+    def __check_columns(self, df):
         self.__check_valid()
         if len(self.columns) != len(set(self.columns)):
             raise ValueError("Duplicate columns not allowed.")
@@ -143,19 +425,113 @@ class FeaEngine(object):
                 raise ValueError("No transformer found for column: {}.".format(column_name))
             if column_name not in df.columns.values:
                 raise ValueError("No column named {} found for df.".format(column_name))
-        
+
+    def transform(self, df):
+        """Transform features for given columns.
+        """
+        self.__check_columns(df)
         for _, row in df.iterrows():
             yield self.transform_row(row)
+            if self.next_report is not None:
+                self.__maybe_report()
+
+    def _map_chunks(self, fn, df_or_chunks, workers, chunksize, max_inflight):
+        """Yield fn(engine, chunk) computed by a pool of worker processes, in input order.
+        At most max_inflight chunks are submitted but not yet consumed.
+        """
+        workers = workers or os.cpu_count()
+        chunks = ((fn, chunk) for chunk in _iter_chunks(df_or_chunks, chunksize))
+        return parallel_imap(_run_chunk, chunks, workers, max_inflight=max_inflight,
+                             initializer=_init_worker, initargs=(self,))
+
+    def transform_parallel(self, df_or_chunks, workers=None, chunksize=10000, max_inflight=None):
+        """Transform features like transform with a pool of worker processes.
+        Params:
+        df_or_chunks: a DataFrame, split into chunks of chunksize rows, or an iterable of DataFrames.
+        workers: number of processes, default to cpu count.
+        max_inflight: max chunks being transformed or waiting to be consumed, default to 2 * workers.
+        Yield (label, features) in input order.
+        """
+        self.__check_valid()
+        for results in self._map_chunks(_transform_chunk, df_or_chunks, workers, chunksize, max_inflight):
+            for result in results:
+                yield result
+
+    def dump_svmlight(self, df_or_chunks, path, compress=None, workers=None, chunksize=10000, compresslevel=6):
+        """Transform and write rows to path in svmlight format, one format_svmlight line per row.
+        Params:
+        df_or_chunks: a DataFrame or an iterable of DataFrames.
+        compress: gzip the output, default to whether path ends with ".gz".
+        compresslevel: gzip level from 1(fastest) to 9(smallest).
+        workers: format chunks with this many processes, rows are still written in input order.
+        Return number of rows written.
+        """
+        self.__check_valid()
+        if compress is None:
+            compress = path.endswith(".gz")
+        if workers:
+            blocks = self._map_chunks(_format_chunk, df_or_chunks, workers, chunksize, None)
+        else:
+            blocks = (_format_chunk(self, chunk) for chunk in _iter_chunks(df_or_chunks, chunksize))
+
+        num_rows = 0
+        with (gzip.open(path, "wb", compresslevel=compresslevel) if compress else open(path, "wb", buffering=1 << 20)) as fout:
+            for count, block in blocks:
+                fout.write(block)
+                num_rows += count
+        return num_rows
+
+    def transform_matrix(self, df):
+        """Transform features for given columns column by column.
+        Return (scipy.sparse.csr_matrix, labels), labels is a numpy array or None if no label column given.
+        Rows of the matrix hold the same features as transform yields.
+        """
+        from scipy.sparse import csr_matrix
+
+        self.__check_columns(df)
+        num_rows = len(df)
+        labels = None
+        rows, indices, data = [], [], []
+        index_from = self.index_from
+        for column_name in self.columns:
+            transformer = self.transformers[column_name]
+            column = df[column_name]
+            target = transformer if self.instruments is None else self.__instrument(column_name)
+            if isinstance(transformer, LabelTransformer):
+                labels = target.transform_column(column)
+                continue
+            column_rows, feaids, values = target.transform_column(column)
+            rows.append(column_rows)
+            indices.append(feaids + index_from)
+            data.append(values)
+            index_from += transformer.width
+
+        rows = numpy.concatenate(rows) if rows else numpy.zeros(0, dtype=numpy.int64)
+        indices = numpy.concatenate(indices) if indices else numpy.zeros(0, dtype=numpy.int64)
+        data = numpy.concatenate(data) if data else numpy.zeros(0, dtype=numpy.float64)
+        # Columns were appended in order, a stable sort by row keeps that order within each row.
+        order = numpy.argsort(rows, kind="stable")
+        indptr = numpy.zeros(num_rows + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(rows, minlength=num_rows), out=indptr[1:])
+        matrix = csr_matrix((data[order], indices[order], indptr), shape=(num_rows, index_from))
+        self.__maybe_report()
+        return matrix, labels
         
     def feature_name(self, fea_idx):
         """Return feature name of given feature index and need columns.
+        Features of hashed columns are named by bucket, e.g. "column-#12".
         Return None if no such feature index found.
         """
         self.__check_valid()
         if not self.feaname_updated:
             self.__update_feaname()
 
-        return self.idx2feaname.get(fea_idx, None)
+        feaname = self.idx2feaname.get(fea_idx, None)
+        if feaname is None:
+            for start, end, column_name in self.hashed_ranges:
+                if start <= fea_idx < end:
+                    return "{}-#{}".format(column_name, fea_idx - start)
+        return feaname
 
     def summary(self):
         self.__check_valid()
@@ -166,6 +542,9 @@ class FeaEngine(object):
             transformer = self.transformers[column_name]
             if isinstance(transformer, LabelTransformer):
                 continue
-            stats.append("column: {}, id: [{}, {}]".format(column_name, index_from, index_from + transformer.num_features - 1))
-            index_from += transformer.num_features
+            stat = "column: {}, id: [{}, {}]".format(column_name, index_from, index_from + transformer.width - 1)
+            if isinstance(transformer, HashingTransformer):
+                stat += ", hashed"
+            stats.append(stat)
+            index_from += transformer.width
         return "\n".join(stats)
\ No newline at end of file
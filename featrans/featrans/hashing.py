@@ -0,0 +1,36 @@
+# coding: utf-8
+import hashlib
+import numpy
+
+
+def stable_hash(text):
+    """Return a 64 bits hash of text which is the same across processes and runs.
+    """
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class CountMinSketch(object):
+    """Approximate counter of terms in fixed memory(depth * width counters).
+    Estimates never underestimate, conservative update keeps overestimates small.
+    """
+    def __init__(self, width=1 << 20, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = numpy.zeros((depth, width), dtype=numpy.uint32)
+
+    def _indices(self, term):
+        h = stable_hash(term)
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, term, count=1):
+        """Count term, return its estimated count after adding.
+        """
+        indices = self._indices(term)
+        rows = self.table
+        estimate = min(int(rows[i, j]) for i, j in enumerate(indices)) + count
+        for i, j in enumerate(indices):
+            if rows[i, j] < estimate:
+                rows[i, j] = estimate
+        return estimate
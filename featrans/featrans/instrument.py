@@ -0,0 +1,46 @@
+# coding: utf-8
+from utils import decorator
+
+
+class ColumnStats(object):
+    """Record time, rows processed and non-zero features emitted by the transformer of a column.
+    Call it in place of transformer.transform, or use transform_column/update in place of the
+    transformer methods.
+    """
+    def __init__(self, transformer):
+        self.transformer = transformer
+        self.rows = 0
+        self.nnz = 0
+        self.loaded_rows = 0
+        self._transform = decorator.timer(transformer.transform)
+        self._transform_column = decorator.timer(transformer.transform_column)
+        self._update = decorator.timer(transformer.update) if hasattr(transformer, "update") else None
+
+    def __call__(self, text):
+        features = self._transform(text)
+        self.rows += 1
+        if not isinstance(features, int):
+            self.nnz += len(features)
+        return features
+
+    def transform_column(self, column):
+        result = self._transform_column(column)
+        self.rows += len(column)
+        if isinstance(result, tuple):
+            self.nnz += len(result[0])
+        return result
+
+    def update(self, column):
+        self._update(column)
+        self.loaded_rows += len(column)
+
+    def summary(self):
+        result = {
+            "transform_seconds": self._transform.cost + self._transform_column.cost,
+            "rows": self.rows,
+            "nnz": self.nnz,
+        }
+        if self._update is not None:
+            result["load_seconds"] = self._update.cost
+            result["loaded_rows"] = self.loaded_rows
+        return result
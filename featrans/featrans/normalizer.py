@@ -1,25 +1,156 @@
 # coding: utf-8
 import numpy
-from collections import defaultdict
 
-class MinMaxNorm(object):
+
+class FeaStats(object):
+    """Running statistics of observed values for each feature id.
+    A feature is observed in `count` samples, the rest samples hold an implicit zero.
+    Statistics are accumulated chunk by chunk, so raw values never need to be kept.
+    mean and m2(sum of squared deviations from mean) are over observed values, and combined with
+    Chan's parallel update, which keeps variance precise for values far from zero.
+    """
+    FIELDS = ("count", "min", "max", "mean", "m2")
+
+    def __init__(self):
+        self.count = numpy.zeros(0, dtype=numpy.int64)
+        self.min = numpy.zeros(0, dtype=numpy.float64)
+        self.max = numpy.zeros(0, dtype=numpy.float64)
+        self.mean = numpy.zeros(0, dtype=numpy.float64)
+        self.m2 = numpy.zeros(0, dtype=numpy.float64)
+
+    def __len__(self):
+        return len(self.count)
+
+    def resize(self, num_features):
+        grow = num_features - len(self.count)
+        if grow <= 0:
+            return
+        self.count = numpy.concatenate([self.count, numpy.zeros(grow, dtype=numpy.int64)])
+        self.min = numpy.concatenate([self.min, numpy.full(grow, numpy.inf)])
+        self.max = numpy.concatenate([self.max, numpy.full(grow, -numpy.inf)])
+        self.mean = numpy.concatenate([self.mean, numpy.zeros(grow)])
+        self.m2 = numpy.concatenate([self.m2, numpy.zeros(grow)])
+
+    def update(self, feaids, values):
+        """Add observed values, feaids[i] is observed with values[i].
+        """
+        feaids = numpy.asarray(feaids, dtype=numpy.int64)
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if len(feaids) == 0:
+            return
+        self.resize(int(feaids.max()) + 1)
+        numpy.minimum.at(self.min, feaids, values)
+        numpy.maximum.at(self.max, feaids, values)
+
+        # Statistics of the chunk, then combined with the accumulated ones.
+        size = len(self.count)
+        chunk_count = numpy.bincount(feaids, minlength=size)
+        chunk_mean = numpy.bincount(feaids, weights=values, minlength=size) / numpy.maximum(chunk_count, 1)
+        deviation = values - chunk_mean[feaids]
+        chunk_m2 = numpy.bincount(feaids, weights=deviation * deviation, minlength=size)
+
+        seen = numpy.flatnonzero(chunk_count)
+        count = self.count[seen]
+        total = count + chunk_count[seen]
+        delta = chunk_mean[seen] - self.mean[seen]
+        self.mean[seen] += delta * chunk_count[seen] / total
+        self.m2[seen] += chunk_m2[seen] + delta * delta * count * chunk_count[seen] / total
+        self.count[seen] = total
+
+    def take(self, feaids):
+        """Return statistics of given feature ids, renumbered from 0 in the given order.
+        """
+        stats = FeaStats()
+        for field in self.FIELDS:
+            setattr(stats, field, getattr(self, field)[feaids])
+        return stats
+
+    def min_max(self, num_samples):
+        """Return (min, max) arrays over num_samples, implicit zeros included.
+        """
+        has_zero = self.count < num_samples
+        min_value = numpy.where(has_zero, numpy.minimum(self.min, 0), self.min)
+        max_value = numpy.where(has_zero, numpy.maximum(self.max, 0), self.max)
+        return min_value, max_value
+
+    def mean_std(self, num_samples):
+        """Return (mean, std) arrays over num_samples, implicit zeros included.
+        """
+        # Combine observed values with num_samples - count zeros.
+        zeros = num_samples - self.count
+        mean = self.mean * self.count / num_samples
+        m2 = self.m2 + self.mean * self.mean * self.count * zeros / num_samples
+        return mean, numpy.sqrt(numpy.maximum(m2 / num_samples, 0))
+
+    def max_abs(self):
+        """Return max absolute value array, implicit zeros never change it.
+        """
+        return numpy.maximum(numpy.abs(self.min), numpy.abs(self.max))
+
+
+class Normalizer(object):
+    """Normalize value of each feature by (value - shift) / scale.
+    Subclasses compute shift and scale from FeaStats.
+    """
     def __init__(self):
-        self.initialized = defaultdict(bool)
-        self.min_max = dict()
+        self.params = dict()
+
+    def __setstate__(self, state):
+        # MinMaxNorm pickled by old versions keeps (min, max) of each feature instead of params.
+        if "min_max" in state:
+            state = {"params": {feaid: (min_value, max_value - min_value if max_value != min_value else 1.0)
+                                for feaid, (min_value, max_value) in state["min_max"].items()}}
+        self.__dict__.update(state)
+
+    def _shift_scale(self, stats, num_samples):
+        raise NotImplementedError
 
     def init(self, feaid, values):
-        min_value = numpy.min(values)
-        max_value = numpy.max(values)
-        self.initialized[feaid] = True
-        self.min_max[feaid] = (min_value, max_value)
-    
-    def __call__(self, feaid, value):
-        """Normalize value by (value - min) / (max - min)
+        """Init one feature from all of its values.
+        """
+        stats = FeaStats()
+        stats.update(numpy.zeros(len(values), dtype=numpy.int64), values)
+        shift, scale = self._shift_scale(stats, len(values))
+        self.params[feaid] = (shift[0], scale[0] if scale[0] != 0 else 1.0)
+
+    def fit(self, stats, num_samples):
+        """Init all features from FeaStats of num_samples samples.
         """
-        if not self.initialized[feaid]:
+        self.params = dict()
+        shift, scale = self._shift_scale(stats, num_samples)
+        # A constant feature has nothing to scale.
+        scale = numpy.where(scale != 0, scale, 1.0)
+        for feaid in numpy.flatnonzero(stats.count > 0).tolist():
+            self.params[feaid] = (shift[feaid], scale[feaid])
+
+    def __call__(self, feaid, value):
+        if feaid not in self.params:
             raise ValueError("feature: {} not initialized.".format(feaid))
-        min_value, max_value = self.min_max[feaid]
-        return (value - min_value) / (max_value - min_value)
+        shift, scale = self.params[feaid]
+        return (value - shift) / scale
+
+
+class MinMaxNorm(Normalizer):
+    """Normalize value by (value - min) / (max - min)
+    """
+    def _shift_scale(self, stats, num_samples):
+        min_value, max_value = stats.min_max(num_samples)
+        return min_value, max_value - min_value
+
+
+class ZScoreNorm(Normalizer):
+    """Normalize value by (value - mean) / std
+    """
+    def _shift_scale(self, stats, num_samples):
+        return stats.mean_std(num_samples)
+
+
+class MaxAbsNorm(Normalizer):
+    """Normalize value by value / max(abs(value))
+    """
+    def _shift_scale(self, stats, num_samples):
+        max_abs = stats.max_abs()
+        return numpy.zeros(len(max_abs)), max_abs
 
 
 def create_normalizer(norm_type):
@@ -27,5 +158,9 @@ def create_normalizer(norm_type):
         return None
     elif norm_type == "min_max":
         return MinMaxNorm()
+    elif norm_type == "z_score":
+        return ZScoreNorm()
+    elif norm_type == "max_abs":
+        return MaxAbsNorm()
     else:
-        raise ValueError("Unsupported normalizer. Supported normalizers: min_max")
\ No newline at end of file
+        raise ValueError("Unsupported normalizer. Supported normalizers: min_max, z_score, max_abs")
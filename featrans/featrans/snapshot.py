@@ -0,0 +1,261 @@
+# coding: utf-8
+"""
+Engine snapshot: a directory holding numpy arrays which can be memory mapped, plus a small pickle
+of everything else.
+
+Vocabularies are stored as utf-8 blobs with offset arrays and a hash table, statistics and
+normalizer parameters as plain arrays. Loading with mmap opens arrays copy-on-write, so forked
+workers share pages and startup does not depend on vocabulary size, else vocabularies are loaded
+into dicts.
+"""
+import copy
+import os
+import zlib
+import _pickle as pickle
+import numpy
+
+from .normalizer import FeaStats
+
+META_FILE = "meta.pkl"
+
+
+class Vocab(object):
+    """A term -> index mapping backed by a utf-8 blob of terms and an open addressing hash table.
+    table[slot] is the position of a term in the blob or -1, terms are probed linearly from
+    slot crc32(term) % len(table), so lookups take O(1) reads of the arrays.
+    Terms added after loading are kept in an overlay dict.
+    """
+    def __init__(self, blob, offsets, ids, table):
+        self.blob = blob
+        self.offsets = offsets
+        self.ids = ids
+        self.table = table
+        self.added = dict()
+        self._views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_views"] = None
+        return state
+
+    def _arrays(self):
+        """Return memoryviews of (blob, offsets, table), they read scalars much faster than numpy.
+        """
+        if self._views is None:
+            self._views = tuple(memoryview(numpy.ascontiguousarray(array))
+                                for array in (self.blob, self.offsets, self.table))
+        return self._views
+
+    @classmethod
+    def from_dict(cls, fea2idx):
+        items = sorted((term.encode("utf-8"), idx) for term, idx in fea2idx.items())
+        lengths = numpy.array([len(term) for term, _ in items], dtype=numpy.int64)
+        offsets = numpy.zeros(len(items) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=offsets[1:])
+        blob = numpy.frombuffer(b"".join(term for term, _ in items), dtype=numpy.uint8)
+        ids = numpy.array([idx for _, idx in items], dtype=numpy.int64)
+
+        # At most half full, so probe sequences stay short.
+        size = 1
+        while size < 2 * len(items):
+            size <<= 1
+        table = numpy.full(size, -1, dtype=numpy.int64)
+        slots = table.tolist()
+        for i, (term, _) in enumerate(items):
+            slot = zlib.crc32(term) % size
+            while slots[slot] >= 0:
+                slot = (slot + 1) % size
+            slots[slot] = i
+        table[:] = slots
+        return cls(blob, offsets, ids, table)
+
+    def _term(self, i):
+        blob, offsets, _ = self._arrays()
+        return blob[offsets[i]:offsets[i + 1]].tobytes()
+
+    def _find(self, term):
+        """Return position of term in the blob, -1 if not found.
+        """
+        blob, offsets, table = self._arrays()
+        size = len(table)
+        if not size:
+            return -1
+        key = term.encode("utf-8")
+        slot = zlib.crc32(key) % size
+        while True:
+            i = table[slot]
+            if i < 0 or blob[offsets[i]:offsets[i + 1]] == key:
+                return i
+            slot = (slot + 1) % size
+
+    def to_dict(self):
+        data = self.blob.tobytes()
+        bounds = self.offsets.tolist()
+        terms = [data[bounds[i]:bounds[i + 1]].decode("utf-8") for i in range(len(self.ids))]
+        fea2idx = dict(zip(terms, self.ids.tolist()))
+        fea2idx.update(self.added)
+        return fea2idx
+
+    def __len__(self):
+        return len(self.ids) + len(self.added)
+
+    def __contains__(self, term):
+        return term in self.added or self._find(term) >= 0
+
+    def __getitem__(self, term):
+        if term in self.added:
+            return self.added[term]
+        i = self._find(term)
+        if i < 0:
+            raise KeyError(term)
+        return int(self.ids[i])
+
+    def __setitem__(self, term, idx):
+        i = self._find(term)
+        if i >= 0:
+            if int(self.ids[i]) != idx:
+                raise ValueError("Term {} already in vocabulary with index {}.".format(term, int(self.ids[i])))
+            return
+        self.added[term] = idx
+
+    def get(self, term, default=None):
+        try:
+            return self[term]
+        except KeyError:
+            return default
+
+    def items(self):
+        for i in range(len(self.ids)):
+            yield self._term(i).decode("utf-8"), int(self.ids[i])
+        for item in self.added.items():
+            yield item
+
+    def keys(self):
+        return (term for term, _ in self.items())
+
+    def __iter__(self):
+        return self.keys()
+
+
+class ArrayParams(object):
+    """Read-only feaid -> normalizer params mapping backed by a params array indexed by feaid,
+    rows of features without params are NaN.
+    """
+    def __init__(self, values):
+        self.values = values
+        self._view = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_view"] = None
+        return state
+
+    @classmethod
+    def from_dict(cls, params):
+        size = max(params) + 1 if params else 0
+        values = numpy.full((size, 2), numpy.nan)
+        for feaid, value in params.items():
+            values[feaid] = value
+        return cls(values)
+
+    def _row(self, feaid):
+        if self._view is None:
+            self._view = memoryview(numpy.ascontiguousarray(self.values))
+        if 0 <= feaid < len(self._view):
+            shift = self._view[feaid, 0]
+            # NaN is the only value not equal to itself.
+            if shift == shift:
+                return shift, self._view[feaid, 1]
+        return None
+
+    def to_dict(self):
+        return {feaid: tuple(row) for feaid, row in self.items()}
+
+    def __len__(self):
+        return int((~numpy.isnan(self.values[:, 0])).sum())
+
+    def __contains__(self, feaid):
+        return self._row(feaid) is not None
+
+    def __getitem__(self, feaid):
+        row = self._row(feaid)
+        if row is None:
+            raise KeyError(feaid)
+        return row
+
+    def items(self):
+        for feaid in numpy.flatnonzero(~numpy.isnan(self.values[:, 0])).tolist():
+            yield feaid, tuple(self.values[feaid])
+
+
+def _array_file(path, i, name):
+    return os.path.join(path, "{}.{}.npy".format(i, name))
+
+
+def save_snapshot(transformers, path):
+    """Save transformers into directory path.
+    """
+    os.makedirs(path, exist_ok=True)
+    skeletons = dict()
+    for i, (column_name, transformer) in enumerate(transformers.items()):
+        arrays = dict()
+        skeleton = copy.copy(transformer)
+        fea2idx = getattr(transformer, "fea2idx", None)
+        if fea2idx is not None and all(isinstance(term, str) for term in fea2idx.keys()):
+            vocab = fea2idx if isinstance(fea2idx, Vocab) and not fea2idx.added else Vocab.from_dict(fea2idx)
+            arrays["blob"], arrays["offsets"], arrays["ids"], arrays["table"] = \
+                vocab.blob, vocab.offsets, vocab.ids, vocab.table
+            skeleton.fea2idx = None
+        stats = getattr(transformer, "stats", None)
+        if stats is not None:
+            for field in FeaStats.FIELDS:
+                arrays["stats_" + field] = getattr(stats, field)
+            skeleton.stats = None
+        sketch = getattr(transformer, "sketch", None)
+        if sketch is not None:
+            arrays["sketch"] = sketch.table
+            skeleton.sketch = copy.copy(sketch)
+            skeleton.sketch.table = None
+        normalizer = getattr(transformer, "normalizer", None)
+        if normalizer is not None and hasattr(normalizer, "params"):
+            params = normalizer.params
+            if not isinstance(params, ArrayParams):
+                params = ArrayParams.from_dict(params)
+            arrays["norm_values"] = params.values
+            skeleton.normalizer = copy.copy(normalizer)
+            skeleton.normalizer.params = None
+
+        for name, array in arrays.items():
+            numpy.save(_array_file(path, i, name), numpy.asarray(array))
+        skeletons[column_name] = (i, skeleton, sorted(arrays))
+
+    with open(os.path.join(path, META_FILE), "wb") as fout:
+        pickle.dump(skeletons, fout)
+
+
+def load_snapshot(path, mmap=False):
+    """Load transformers from directory path, memory map arrays copy-on-write if mmap.
+    Vocabularies and normalizer params are arrays if mmap, else dicts which are faster to look up.
+    """
+    with open(os.path.join(path, META_FILE), "rb") as fin:
+        skeletons = pickle.load(fin)
+
+    mmap_mode = "c" if mmap else None
+    transformers = dict()
+    for column_name, (i, transformer, names) in skeletons.items():
+        arrays = {name: numpy.load(_array_file(path, i, name), mmap_mode=mmap_mode) for name in names}
+        if "blob" in arrays:
+            vocab = Vocab(arrays["blob"], arrays["offsets"], arrays["ids"], arrays["table"])
+            transformer.fea2idx = vocab if mmap else vocab.to_dict()
+        if "stats_count" in arrays:
+            stats = FeaStats()
+            for field in FeaStats.FIELDS:
+                setattr(stats, field, arrays["stats_" + field])
+            transformer.stats = stats
+        if "sketch" in arrays:
+            transformer.sketch.table = arrays["sketch"]
+        if "norm_values" in arrays:
+            params = ArrayParams(arrays["norm_values"])
+            transformer.normalizer.params = params if mmap else params.to_dict()
+        transformers[column_name] = transformer
+    return transformers
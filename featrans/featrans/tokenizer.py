@@ -0,0 +1,46 @@
+# coding: utf-8
+import re
+
+REGEX_CHARS = set(".^$*+?{}[]\\|()")
+
+
+class Tokenizer(object):
+    """Split text into stripped, non-empty terms.
+    Params:
+    sep: separator regex. A separator without regex special chars is split by str.split,
+        None keeps the whole text as one term.
+    ngram: also emit n-grams of up to ngram consecutive terms, joined by joiner.
+    """
+    def __init__(self, sep=None, ngram=1, joiner=" "):
+        if ngram < 1:
+            raise ValueError("ngram must be at least 1.")
+        self.sep = sep
+        self.ngram = ngram
+        self.joiner = joiner
+        self.literal = sep if sep and not set(sep) & REGEX_CHARS else None
+        self.pattern = re.compile(sep) if sep and self.literal is None else None
+
+    def tokenize(self, text):
+        if self.literal is not None:
+            parts = text.split(self.literal)
+        elif self.pattern is not None:
+            parts = self.pattern.split(text)
+        else:
+            parts = [text]
+        terms = [term for term in map(str.strip, parts) if term]
+        if self.ngram > 1:
+            terms = self._add_ngrams(terms)
+        return terms
+
+    def tokenize_batch(self, texts):
+        """Tokenize an iterable of texts, e.g. a pandas column, return a list of term lists.
+        """
+        tokenize = self.tokenize
+        return [tokenize(text) for text in texts]
+
+    def _add_ngrams(self, terms):
+        ngrams = list(terms)
+        join = self.joiner.join
+        for n in range(2, self.ngram + 1):
+            ngrams.extend(join(terms[i:i + n]) for i in range(len(terms) - n + 1))
+        return ngrams
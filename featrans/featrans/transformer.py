@@ -1,15 +1,43 @@
 # coding: utf-8
-from collections import Counter, defaultdict
-import re
+from collections import Counter
 import numpy
 import time
 import sys
 
 from utils import decorator
+from .normalizer import FeaStats
+from .hashing import stable_hash, CountMinSketch
+from .tokenizer import Tokenizer
+
+# Max number of distinct texts memoized per transformer.
+CACHE_MAXSIZE = 100000
+
+
+def _factorize(column):
+    """Encode column as (codes, uniques) so that each distinct text is handled once.
+    """
+    codes, uniques = column.factorize()
+    if len(codes) and codes.min() < 0:
+        raise ValueError("Column {} contains missing values.".format(column.name))
+    return codes, uniques
+
+
+def _uncached_transform(transformer):
+    """Return transform of transformer bypassing its memory cache.
+    Column paths handle each distinct text once, so caching them only evicts the hot texts of transform.
+    """
+    transform = type(transformer).transform
+    return getattr(transform, "__wrapped__", transform).__get__(transformer)
 
 
 class LabelTransformer(object):
-    @decorator.memory()
+    def clear_cache(self):
+        type(self).transform.cache_clear(self)
+
+    def cache_info(self):
+        return type(self).transform.cache_info(self)
+
+    @decorator.memory(maxsize=CACHE_MAXSIZE, per_instance=True)
     def transform(self, text):
         text = text.strip()
         if not text:
@@ -20,53 +48,232 @@ class LabelTransformer(object):
         else:
             return -1
 
+    def transform_column(self, column):
+        """Transform a whole label column, return labels as numpy array.
+        """
+        codes, uniques = _factorize(column)
+        transform = _uncached_transform(self)
+        labels = numpy.array([transform(text) for text in uniques], dtype=numpy.int64)
+        return labels[codes]
+
 class FeatureTransformer(object):
+    # Number of indices reserved for the column, None to take just num_features.
+    capacity = None
+
     def __init__(self):
         self.normalizer = None
         self.column_name = None
         self.fea2idx = dict()
-        self.fea2values = defaultdict(list)
+        self.stats = FeaStats()
         self.num_features = 0
         self.num_samples = 0
 
+    def __setstate__(self, state):
+        # Transformers pickled by old versions keep raw values of each feature instead of stats.
+        fea2values = state.pop("fea2values", None)
+        self.__dict__.update(state)
+        if fea2values is not None:
+            self.stats = FeaStats()
+            for fea, values in fea2values.items():
+                self.stats.update(numpy.full(len(values), self.fea2idx[fea], dtype=numpy.int64), values)
+
     def _init_normalizer(self):
         if self.normalizer:
-            for fea, values in self.fea2values.items():
-                values = numpy.pad(values, (0, self.num_samples - len(values)), "constant", constant_values=0)
-                feaid = self.fea2idx[fea]
-                self.normalizer.init(feaid, values)
-    
+            self.normalizer.fit(self.stats, self.num_samples)
+        # Memoized results depend on the normalizer.
+        self.clear_cache()
+
+    def clear_cache(self):
+        transform = type(self).transform
+        if hasattr(transform, "cache_clear"):
+            transform.cache_clear(self)
+
+    def cache_info(self):
+        transform = type(self).transform
+        if hasattr(transform, "cache_info"):
+            return transform.cache_info(self)
+        return None
+
     def set_normalizer(self, normalizer):
         self.normalizer = normalizer
         self._init_normalizer()
 
-    def load(self, column, init_feaidx):
+    def reset(self):
+        """Forget everything loaded.
+        """
+        self.fea2idx = dict()
+        self.stats = FeaStats()
+        self.num_features = 0
+        self.num_samples = 0
+        self.capacity = None
+        self.clear_cache()
+
+    @property
+    def width(self):
+        """Number of indices the column takes in the engine layout.
+        """
+        return self.capacity if self.capacity is not None else self.num_features
+
+    def update(self, column):
+        """Load one chunk of the column, features and statistics are accumulated across chunks.
+        Call fit after the last chunk.
+        """
         raise NotImplementedError
 
+    def fit(self, prune=True):
+        """Finish loading, init normalizer from accumulated statistics.
+        Params:
+        prune: drop features by pruning options of the transformer, which renumbers features.
+        """
+        self._init_normalizer()
+
+    def load(self, column):
+        self.reset()
+        self.update(column)
+        self.fit()
+
     def transform(self, text):
         raise NotImplementedError
 
+    def transform_column(self, column):
+        """Transform a whole column, return (rows, feaids, values) numpy arrays
+        ordered by row and then by the order given by transform.
+        """
+        codes, uniques = _factorize(column)
+        lengths = numpy.zeros(len(uniques), dtype=numpy.int64)
+        feaids = []
+        values = []
+        transform = _uncached_transform(self)
+        for i, text in enumerate(uniques):
+            features = transform(text)
+            lengths[i] = len(features)
+            for feaid, value in features:
+                feaids.append(feaid)
+                values.append(value)
 
-class CategoryTransformer(FeatureTransformer):
-    def __init__(self):
+        # Expand the features of each distinct text to every row holding it.
+        starts = numpy.cumsum(lengths) - lengths
+        counts = lengths[codes]
+        rows = numpy.repeat(numpy.arange(len(codes), dtype=numpy.int64), counts)
+        row_starts = numpy.cumsum(counts) - counts
+        positions = numpy.repeat(starts[codes] - row_starts, counts) + numpy.arange(len(rows), dtype=numpy.int64)
+        feaids = numpy.array(feaids, dtype=numpy.int64)[positions]
+        values = numpy.array(values, dtype=numpy.float64)[positions]
+        return rows, feaids, values
+
+
+class VocabTransformer(FeatureTransformer):
+    """Transformer with a vocabulary learned from data, which can be pruned by document frequency.
+    Params:
+    min_df: drop terms in less than min_df samples. Samples are counted by a CountMinSketch
+        of sketch_width counters per row, so rare terms never enter the vocabulary.
+        Values of a term before it enters are taken as zeros by normalizers.
+    max_df: drop terms in more than max_df samples, a float is a fraction of samples.
+    max_features: keep only the max_features terms in most samples.
+    keep_sketch: keep the sketch after fit, so samples of min_df seen by later update calls add up.
+        It takes 16 bytes per sketch_width, which are saved with the transformer.
+    """
+    def __init__(self, min_df=1, max_df=None, max_features=None, sketch_width=1 << 20, keep_sketch=False):
         super().__init__()
+        self.min_df = min_df
+        self.max_df = max_df
+        self.max_features = max_features
+        self.sketch_width = sketch_width
+        self.keep_sketch = keep_sketch
+        self.sketch = None
 
-    def load(self, column):
-        fea2idx = dict()
+    def __setstate__(self, state):
+        # Old versions had no pruning options.
+        state.setdefault("min_df", 1)
+        state.setdefault("max_df", None)
+        state.setdefault("max_features", None)
+        state.setdefault("sketch_width", 1 << 20)
+        state.setdefault("keep_sketch", False)
+        state.setdefault("sketch", None)
+        super().__setstate__(state)
+
+    def reset(self):
+        super().reset()
+        self.sketch = None
+
+    def _index(self, term):
+        """Return index of term, add it to vocabulary once it is in min_df samples.
+        Return None if term is not in vocabulary.
+        """
+        idx = self.fea2idx.get(term)
+        if idx is not None:
+            return idx
+        if self.capacity is not None and len(self.fea2idx) >= self.capacity:
+            return None
+        seen = 1
+        if self.min_df > 1:
+            if self.sketch is None:
+                self.sketch = CountMinSketch(self.sketch_width)
+            seen = self.sketch.add(term)
+            if seen < self.min_df:
+                return None
+        idx = len(self.fea2idx)
+        self.fea2idx[term] = idx
+        if seen > 1:
+            # Count samples seen before the term entered, for max_df and max_features.
+            self.stats.resize(idx + 1)
+            self.stats.count[idx] += seen - 1
+        return idx
+
+    def _prune(self):
+        if self.max_df is None and self.max_features is None:
+            return
+        self.stats.resize(len(self.fea2idx))
+        df = self.stats.count
+        keep = numpy.ones(len(df), dtype=bool)
+        if self.max_df is not None:
+            max_df = self.max_df * self.num_samples if isinstance(self.max_df, float) else self.max_df
+            keep &= df <= max_df
+        if self.max_features is not None and keep.sum() > self.max_features:
+            candidates = numpy.flatnonzero(keep)
+            # Most frequent first, earlier terms first among ties.
+            order = numpy.lexsort((candidates, -df[candidates]))
+            keep[:] = False
+            keep[candidates[order[:self.max_features]]] = True
+        if keep.all():
+            return
+
+        kept = numpy.flatnonzero(keep)
+        new_ids = numpy.full(len(keep), -1, dtype=numpy.int64)
+        new_ids[kept] = numpy.arange(len(kept))
+        self.fea2idx = {term: int(new_ids[idx]) for term, idx in sorted(self.fea2idx.items(), key=lambda it: it[1])
+                        if keep[idx]}
+        self.stats = self.stats.take(kept)
+        self.num_features = len(self.fea2idx)
+
+    def fit(self, prune=True):
+        if prune:
+            self._prune()
+        if not self.keep_sketch:
+            self.sketch = None
+        super().fit()
+
+
+class CategoryTransformer(VocabTransformer):
+    def __init__(self, min_df=1, max_df=None, max_features=None, sketch_width=1 << 20, keep_sketch=False):
+        super().__init__(min_df, max_df, max_features, sketch_width, keep_sketch)
+
+    def update(self, column):
+        feaids = []
         for text in column:
             text = text.strip()
             if not text:
                 continue
-            if text not in fea2idx:
-                idx = len(fea2idx)
-                fea2idx[text] = idx
+            idx = self._index(text)
+            if idx is not None:
+                feaids.append(idx)
 
+        self.stats.update(feaids, numpy.ones(len(feaids)))
         self.column_name = column.name
-        self.fea2idx = fea2idx
-        self.num_features = len(fea2idx)
-        self.num_samples = len(column)
+        self.num_features = len(self.fea2idx)
+        self.num_samples += len(column)
 
-    @decorator.memory()
+    @decorator.memory(maxsize=CACHE_MAXSIZE, per_instance=True)
     def transform(self, text):
         text = text.strip()
         if text in self.fea2idx:
@@ -75,39 +282,39 @@ class CategoryTransformer(FeatureTransformer):
             return []
 
 
-class TextTransformer(FeatureTransformer):
-    def __init__(self, normalizer, sep):
-        super().__init__()
+class TextTransformer(VocabTransformer):
+    def __init__(self, normalizer, sep, min_df=1, max_df=None, max_features=None, sketch_width=1 << 20, ngram=1,
+                 keep_sketch=False):
+        super().__init__(min_df, max_df, max_features, sketch_width, keep_sketch)
         self.normalizer = normalizer
-        self.sep_pattern = re.compile(sep) if sep else None
+        self.tokenizer = Tokenizer(sep, ngram)
 
-    def load(self, column):
-        fea2idx = dict()
-        fea2values = defaultdict(list)
-        for text in column:
-            terms = re.split(self.sep_pattern, text) if self.sep_pattern else [text]
-            terms = (it.strip() for it in terms if it.strip())
-            counter = Counter(terms)
-            for term, count in counter.items():
-                if term not in fea2idx:
-                    fea2idx[term] = len(fea2idx)
-                fea2values[term].append(count)
-
-        assert len(fea2idx) == len(fea2values)
-        self.fea2idx = fea2idx
-        self.fea2values = fea2values
+    def __setstate__(self, state):
+        # Old versions split texts by a compiled sep_pattern.
+        if "sep_pattern" in state:
+            sep_pattern = state.pop("sep_pattern")
+            state["tokenizer"] = Tokenizer(sep_pattern.pattern if sep_pattern else None)
+        super().__setstate__(state)
+
+    def update(self, column):
+        feaids = []
+        values = []
+        for terms in self.tokenizer.tokenize_batch(column):
+            for term, count in Counter(terms).items():
+                idx = self._index(term)
+                if idx is not None:
+                    feaids.append(idx)
+                    values.append(count)
+
+        self.stats.update(feaids, values)
         self.column_name = column.name
         self.num_features = len(self.fea2idx)
-        self.num_samples = len(column)
-        self._init_normalizer()
+        self.num_samples += len(column)
     
-    @decorator.memory()
+    @decorator.memory(maxsize=CACHE_MAXSIZE, per_instance=True)
     def transform(self, text):
         features = []
-        terms = re.split(self.sep_pattern, text) if self.sep_pattern else [text]
-        terms = (it.strip() for it in terms if it.strip())
-        counter = Counter(terms)
-        for term, count in counter.items():
+        for term, count in Counter(self.tokenizer.tokenize(text)).items():
             if term in self.fea2idx:
                 feaid = self.fea2idx[term]
                 value = count
@@ -124,7 +331,7 @@ class NumericTransformer(FeatureTransformer):
         self.default_value = default_value
         self.normalizer = normalizer
 
-    def load(self, column):
+    def update(self, column):
         values = []
         for text in column:
             text = text.strip()
@@ -134,13 +341,12 @@ class NumericTransformer(FeatureTransformer):
             values.append(value)
 
         self.fea2idx[column.name] = 0
-        self.fea2values[column.name] = values
+        self.stats.update(numpy.zeros(len(values), dtype=numpy.int64), values)
         self.column_name = column.name
         self.num_features = len(self.fea2idx)
-        self.num_samples = len(column)
-        self._init_normalizer()
+        self.num_samples += len(column)
     
-    @decorator.memory()
+    @decorator.memory(maxsize=CACHE_MAXSIZE, per_instance=True)
     def transform(self, text):
         text = text.strip()
         value = self.default_value
@@ -153,4 +359,66 @@ class NumericTransformer(FeatureTransformer):
             return [(feaid, value)]
         else:
             return []
-        
\ No newline at end of file
+
+    def transform_column(self, column):
+        feaid = self.fea2idx[self.column_name]
+        values = numpy.array([float(text) if text.strip() else self.default_value for text in column],
+                             dtype=numpy.float64)
+        if self.normalizer:
+            values = self.normalizer(feaid, values)
+        rows = numpy.flatnonzero(values != 0)
+        feaids = numpy.full(len(rows), feaid, dtype=numpy.int64)
+        return rows, feaids, values[rows]
+        
+
+
+class HashingTransformer(FeatureTransformer):
+    """Map terms to n_features buckets by stable_hash instead of a learned vocabulary.
+    One bit of the hash gives the sign of the value, so collisions tend to cancel out.
+    Nothing needs to be fitted, normalizer is not supported.
+    """
+    def __init__(self, n_features):
+        super().__init__()
+        if n_features <= 0:
+            raise ValueError("n_features must be positive.")
+        self.num_features = n_features
+
+    def reset(self):
+        self.num_samples = 0
+        self.clear_cache()
+
+    def update(self, column):
+        self.column_name = column.name
+        self.num_samples += len(column)
+
+    def set_normalizer(self, normalizer):
+        if normalizer:
+            raise ValueError("{} do not support normalizer.".format(type(self).__name__))
+
+    def _bucket(self, term):
+        h = stable_hash(term)
+        sign = -1 if h >> 63 else 1
+        return h % self.num_features, sign
+
+
+class HashingCategoryTransformer(HashingTransformer):
+    @decorator.memory(maxsize=CACHE_MAXSIZE, per_instance=True)
+    def transform(self, text):
+        text = text.strip()
+        if not text:
+            return []
+        return [self._bucket(text)]
+
+
+class HashingTextTransformer(HashingTransformer):
+    def __init__(self, sep, n_features, ngram=1):
+        super().__init__(n_features)
+        self.tokenizer = Tokenizer(sep, ngram)
+
+    @decorator.memory(maxsize=CACHE_MAXSIZE, per_instance=True)
+    def transform(self, text):
+        bucket2value = dict()
+        for term, count in Counter(self.tokenizer.tokenize(text)).items():
+            bucket, sign = self._bucket(term)
+            bucket2value[bucket] = bucket2value.get(bucket, 0) + sign * count
+        return [(bucket, value) for bucket, value in bucket2value.items() if value != 0]
@@ -2,9 +2,23 @@
 import unittest
 import pandas
 import os
+import shutil
+import gzip
+import pickle
+import re
+from collections import defaultdict
 
-from featrans.feaengine import FeaEngine
+from featrans.feaengine import FeaEngine, format_svmlight
 from featrans.normalizer import MinMaxNorm
+from featrans.transformer import LabelTransformer, TextTransformer, NumericTransformer
+
+
+def legacy(cls, **state):
+    """Return an object of cls holding state, as pickled by old versions.
+    """
+    obj = cls.__new__(cls)
+    obj.__dict__.update(state)
+    return obj
 
 class TestFeaengine(unittest.TestCase):
     def setUp(self):
@@ -51,6 +65,117 @@ class TestFeaengine(unittest.TestCase):
         feaname = self.feaengine.feature_name(3)
         self.assertEqual(feaname, "fea1-e")
 
+    def test_hashing(self):
+        transformers = [("label", "label"), ("fea1", "text_hash", ",", 8), ("fea2", "num", None, 1.0)]
+        self.feaengine.update_transformers(transformers).update_columns(["label", "fea1", "fea2"])
+        self.feaengine.load(self.df)
+        self.assertEqual("column: fea1, id: [0, 7], hashed\ncolumn: fea2, id: [8, 8]", self.feaengine.summary())
+        self.assertEqual("fea1-#3", self.feaengine.feature_name(3))
+        self.assertEqual("fea2-fea2", self.feaengine.feature_name(8))
+        for _, features in self.feaengine.transform(self.df):
+            self.assertTrue(all(0 <= idx < 9 for idx, _ in features))
+
+    def test_update(self):
+        self.feaengine.update_transformers(self.transformers).update_columns(["label", "fea1", "fea2"])
+        self.feaengine.load(self.df)
+        self.feaengine.reserve(2)
+        self.assertEqual("column: fea1, id: [0, 6]\ncolumn: fea2, id: [7, 7]", self.feaengine.summary())
+        expected = list(self.feaengine.transform(self.df))
+
+        df = pandas.DataFrame({"label": ["1", "0"], "fea1": ["g,a", "h,i"], "fea2": ["5", "1"]})
+        self.feaengine.update(df)
+        transformer = self.feaengine.transformers["fea1"]
+        self.assertEqual(7, transformer.num_features)
+        self.assertEqual(5, transformer.fea2idx["g"])
+        self.assertEqual(6, transformer.fea2idx["h"])
+        self.assertNotIn("i", transformer.fea2idx)
+        self.assertEqual(7, transformer.num_samples)
+        self.assertEqual("fea1-h", self.feaengine.feature_name(6))
+        self.assertEqual("column: fea1, id: [0, 6]\ncolumn: fea2, id: [7, 7]", self.feaengine.summary())
+        # Known terms keep their indices, values follow the merged statistics.
+        for (label, features), (expected_label, expected_features) in zip(self.feaengine.transform(self.df), expected):
+            self.assertEqual(expected_label, label)
+            self.assertListEqual([idx for idx, _ in expected_features], [idx for idx, _ in features])
+
+    def test_update_prune(self):
+        transformers = [("label", "label"), ("fea1", "text", None, ",", {"min_df": 2, "max_features": 3, "keep_sketch": True})]
+        self.feaengine.update_transformers(transformers).update_columns(["label", "fea1"])
+        self.feaengine.load(self.df)
+        transformer = self.feaengine.transformers["fea1"]
+        self.assertDictEqual({"a": 0, "c": 1, "f": 2}, transformer.fea2idx)
+
+        # Samples of min_df add up across updates.
+        df = pandas.DataFrame({"label": ["1"], "fea1": ["new"]})
+        self.feaengine.update(df)
+        self.assertNotIn("new", transformer.fea2idx)
+        self.feaengine.update(df)
+        self.assertEqual(3, transformer.fea2idx["new"])
+
+        self.feaengine.update(pandas.DataFrame({"label": ["1"] * 3, "fea1": ["new,d", "new,d", "new"]}), prune=True)
+        self.assertDictEqual({"a": 0, "c": 1, "new": 2}, transformer.fea2idx)
+        self.assertEqual(3, transformer.num_features)
+
+    def test_compile(self):
+        self.feaengine.update_transformers(self.transformers).update_columns(["label", "fea1", "fea2"])
+        self.feaengine.load(self.df)
+        plan = self.feaengine.compile()
+        rows = [{"label": label, "fea1": fea1, "fea2": fea2} for label, fea1, fea2 in zip(self.data["label"], self.data["fea1"], self.data["fea2"])]
+        expected = [(label, [idx for idx, _ in features], [value for _, value in features])
+                    for label, features in self.min_max_feas]
+        self.assertTupleEqual(expected[0], plan(rows[0]))
+        self.assertListEqual(expected, plan(rows))
+        del rows[0]["label"]
+        self.assertTupleEqual((None,) + expected[0][1:], plan(rows[0]))
+
+    def test_stats(self):
+        reports = []
+        self.feaengine.update_transformers(self.transformers).update_columns(["label", "fea1", "fea2"])
+        self.feaengine.enable_stats(interval=0, callback=reports.append)
+        self.feaengine.load(self.df)
+        list(self.feaengine.transform(self.df))
+        self.feaengine.transform_matrix(self.df)
+        stats = self.feaengine.stats()
+        self.assertEqual(10, stats["fea1"]["rows"])
+        self.assertEqual(5, stats["fea1"]["loaded_rows"])
+        self.assertEqual(2 * 10, stats["fea1"]["nnz"])
+        self.assertEqual(10, stats["label"]["rows"])
+        self.assertTrue(stats["fea2"]["transform_seconds"] > 0)
+        self.assertEqual(5, stats["fea1"]["cache_misses"])
+        self.assertTrue(len(reports) > 0)
+
+        self.feaengine.disable_stats()
+        self.assertNotIn("rows", self.feaengine.stats()["fea1"])
+
+    def test_load_stream(self):
+        self.feaengine.update_transformers(self.transformers).update_columns(["label", "fea1", "fea2"])
+        chunks = [self.df.iloc[i:i+2] for i in range(0, len(self.df), 2)]
+        self.feaengine.load_stream(iter(chunks))
+        self.assertEqual(5, self.feaengine.transformers["fea1"].num_samples)
+        self.__internal_test_transform(self.feaengine, True)
+        self.__internal_test_transform(self.feaengine, False)
+
+    def test_transform_parallel(self):
+        self.feaengine.update_transformers(self.transformers).update_columns(["label", "fea1", "fea2"])
+        self.feaengine.load(self.df)
+        results = list(self.feaengine.transform_parallel(self.df, workers=2, chunksize=2, max_inflight=2))
+        self.assertListEqual(list(self.feaengine.transform(self.df)), results)
+
+    def test_dump_svmlight(self):
+        self.feaengine.update_transformers(self.transformers).update_columns(["label", "fea1", "fea2"])
+        self.feaengine.load(self.df)
+        expected = "".join(format_svmlight(label, features) + "\n" for label, features in self.feaengine.transform(self.df))
+        self.assertTrue(expected.startswith("1 0:1.0 1:1.0\n"))
+        f = "test.svm.gz"
+        self.assertEqual(5, self.feaengine.dump_svmlight(self.df, f, chunksize=2, compresslevel=1))
+        with gzip.open(f, "rb") as fin:
+            self.assertEqual(expected.encode("utf-8"), fin.read())
+        f = "test.svm"
+        self.feaengine.dump_svmlight(self.df, f, workers=2, chunksize=2)
+        with open(f, "rb") as fin:
+            self.assertEqual(expected.encode("utf-8"), fin.read())
+        os.remove("test.svm.gz")
+        os.remove(f)
+
     def __internal_test_transform(self, engine, is_minmax):
         columns = ["label", "fea1", "fea2"]
         engine.update_columns(columns)
@@ -72,4 +197,69 @@ class TestFeaengine(unittest.TestCase):
         feaengine2.load_engine(f)
         self.__internal_test_transform(feaengine2, True)
         self.__internal_test_transform(feaengine2, False)
-        os.remove(f)
\ No newline at end of file
+        os.remove(f)
+
+    def test_load_legacy_pickle(self):
+        f = "test.txt"
+        text_norm = legacy(MinMaxNorm, initialized=defaultdict(bool, {i: True for i in range(5)}),
+                           min_max={0: (0, 2), 1: (0, 1), 2: (0, 1), 3: (0, 1), 4: (0, 1)})
+        num_norm = legacy(MinMaxNorm, initialized=defaultdict(bool, {0: True}), min_max={0: (1.0, 3.0)})
+        transformers = {
+            "label": legacy(LabelTransformer),
+            "fea1": legacy(TextTransformer, normalizer=text_norm, column_name="fea1", sep_pattern=re.compile(","),
+                           fea2idx={"a": 0, "c": 1, "d": 2, "e": 3, "f": 4}, num_features=5, num_samples=5,
+                           fea2values=defaultdict(list, {"a": [2, 1, 1], "c": [1, 1, 1], "d": [1], "e": [1], "f": [1, 1]})),
+            "fea2": legacy(NumericTransformer, normalizer=num_norm, column_name="fea2", default_value=1.0,
+                           fea2idx={"fea2": 0}, num_features=1, num_samples=5,
+                           fea2values=defaultdict(list, {"fea2": [1.0, 2.0, 3.0, 1.0, 3.0]})),
+        }
+        with open(f, "wb") as fout:
+            pickle.dump(transformers, fout)
+        feaengine2 = FeaEngine()
+        feaengine2.load_engine(f)
+        feaengine2.update_columns(["label", "fea1", "fea2"])
+        self.assertListEqual(self.min_max_feas, list(feaengine2.transform(self.df)))
+        # Normalizers refit from the migrated statistics.
+        self.__internal_test_transform(feaengine2, True)
+        self.__internal_test_transform(feaengine2, False)
+        os.remove(f)
+
+    def test_transform_matrix(self):
+        transformers = [
+            ("label", "label"),
+            ("fea1", "text", None, ","),
+            ("fea2", "num", None, 1.0)
+        ]
+        self.feaengine.update_transformers(transformers).update_columns(["label", "fea1", "fea2"])
+        self.feaengine.load(self.df)
+        matrix, labels = self.feaengine.transform_matrix(self.df)
+        self.assertEqual((5, 6), matrix.shape)
+        self.assertListEqual([label for label, _ in self.raw_feas], labels.tolist())
+        for i, (_, expected_features) in enumerate(self.raw_feas):
+            row = matrix.getrow(i)
+            self.assertListEqual(expected_features, list(zip(row.indices.tolist(), row.data.tolist())))
+
+    def test_save_load_snapshot(self):
+        f = "test_snapshot"
+        transformers = self.transformers + [("fea3", "category")]
+        self.df["fea3"] = pandas.Series(["x", "y", "x", "", "\u4e2d"])
+        self.feaengine.update_transformers(transformers)
+        self.feaengine.load(self.df)
+        self.feaengine.save_engine(f, format="snapshot")
+        feaengine2 = FeaEngine()
+        feaengine2.load_engine(f, mmap=True)
+        self.assertEqual(self.feaengine.transformers["fea3"].fea2idx, dict(feaengine2.transformers["fea3"].fea2idx.items()))
+        self.assertListEqual([(2, 1)], feaengine2.transformers["fea3"].transform("\u4e2d"))
+        self.__internal_test_transform(feaengine2, True)
+        self.__internal_test_transform(feaengine2, False)
+        self.assertNotIn("z", feaengine2.transformers["fea3"].fea2idx)
+
+        feaengine2.update(pandas.DataFrame({"fea1": ["a,g"], "fea2": ["4"], "fea3": ["z"]}))
+        self.assertEqual(3, feaengine2.transformers["fea3"].fea2idx["z"])
+        self.assertEqual(5, feaengine2.transformers["fea1"].fea2idx["g"])
+
+        feaengine3 = FeaEngine()
+        feaengine3.load_engine(f)
+        self.assertIsInstance(feaengine3.transformers["fea3"].fea2idx, dict)
+        self.assertEqual(self.feaengine.transformers["fea3"].fea2idx, feaengine3.transformers["fea3"].fea2idx)
+        shutil.rmtree(f)
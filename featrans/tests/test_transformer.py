@@ -1,9 +1,24 @@
 # coding: utf-8
+import pickle
 import unittest
+import numpy
 import pandas 
 
 from featrans.transformer import TextTransformer, NumericTransformer, CategoryTransformer
-from featrans.normalizer import MinMaxNorm
+from featrans.transformer import HashingTextTransformer, HashingCategoryTransformer
+from featrans.tokenizer import Tokenizer
+from featrans.normalizer import MinMaxNorm, ZScoreNorm, MaxAbsNorm
+
+
+class TestTokenizer(unittest.TestCase):
+    def test_tokenize(self):
+        self.assertListEqual(["a", "b c"], Tokenizer(",").tokenize(" a,,b c ,"))
+        self.assertIsNotNone(Tokenizer(",").literal)
+        self.assertListEqual(["a", "b", "c"], Tokenizer(",| ").tokenize(" a,,b c ,"))
+        self.assertListEqual(["a,b"], Tokenizer(None).tokenize(" a,b "))
+        self.assertListEqual([], Tokenizer(",").tokenize(" , "))
+        self.assertListEqual(["a", "b", "c", "a b", "b c"], Tokenizer(",", ngram=2).tokenize("a,b,c"))
+        self.assertListEqual([["a"], []], Tokenizer(",").tokenize_batch(pandas.Series(["a", ""])))
 
 
 class TestTextTransformer(unittest.TestCase):
@@ -36,6 +51,40 @@ class TestTextTransformer(unittest.TestCase):
             features = self.transformer.transform(text)
             self.assertListEqual(expected, features)
 
+    def test_stats_normalizers(self):
+        # Counts of "a" over all samples are [2, 1, 0, 1, 0].
+        self.transformer.load(self.column)
+        self.transformer.set_normalizer(ZScoreNorm())
+        mean, std = 0.8, (6 / 5 - 0.8 ** 2) ** 0.5
+        feaid, value = self.transformer.transform("a,a")[0]
+        self.assertEqual(0, feaid)
+        self.assertAlmostEqual((2 - mean) / std, value)
+
+        self.transformer.set_normalizer(MaxAbsNorm())
+        self.assertListEqual([(0, 0.5), (1, 1.0)], self.transformer.transform("a,c"))
+
+    def test_prune(self):
+        # Samples of terms: a 3, c 3, d 1, e 1, f 2.
+        transformer = TextTransformer(None, ",", min_df=2)
+        transformer.load(self.column)
+        self.assertDictEqual({"a": 0, "c": 1, "f": 2}, transformer.fea2idx)
+        self.assertListEqual([3, 3, 2], transformer.stats.count.tolist())
+        # Dropped after fit unless kept for later updates.
+        self.assertIsNone(transformer.sketch)
+        self.assertLess(len(pickle.dumps(transformer)), 10000)
+        transformer = TextTransformer(None, ",", min_df=2, keep_sketch=True)
+        transformer.load(self.column)
+        # "d" was seen once.
+        self.assertEqual(2, transformer.sketch.add("d"))
+
+        transformer = TextTransformer(None, ",", max_features=2)
+        transformer.load(self.column)
+        self.assertDictEqual({"a": 0, "c": 1}, transformer.fea2idx)
+
+        transformer = TextTransformer(None, ",", max_df=0.5)
+        transformer.load(self.column)
+        self.assertDictEqual({"d": 0, "e": 1, "f": 2}, transformer.fea2idx)
+        self.assertListEqual([(0, 1), (2, 1)], transformer.transform("a,d,f"))
 
 class TestNumericTransformer(unittest.TestCase):
     def setUp(self):
@@ -67,6 +116,19 @@ class TestNumericTransformer(unittest.TestCase):
             features = self.transformer.transform(text)
             self.assertListEqual(expected, features)
 
+    def test_z_score_large_values(self):
+        transformer = NumericTransformer(ZScoreNorm(), 0.0)
+        values = 1e9 + numpy.random.default_rng(0).random(10000)
+        column = pandas.Series([repr(float(value)) for value in values], name="n")
+        transformer.reset()
+        for start in range(0, len(column), 3000):
+            transformer.update(column[start:start + 3000])
+        transformer.fit()
+        shift, scale = transformer.normalizer.params[0]
+        self.assertAlmostEqual(values.mean(), shift, delta=1e-6)
+        self.assertAlmostEqual(values.std(), scale, places=6)
+
+
 class TestCategoryTransformer(unittest.TestCase):
     def setUp(self):
         self.transformer = CategoryTransformer()
@@ -88,6 +150,45 @@ class TestCategoryTransformer(unittest.TestCase):
         for text, expected in cases:
             features = self.transformer.transform(text)
             self.assertListEqual(expected, features)
-        
+
+    def test_cache(self):
+        self.transformer.load(self.column)
+        self.transformer.transform("1")
+        self.transformer.transform("1")
+        info = self.transformer.cache_info()
+        self.assertEqual((1, 1, 1), (info.hits, info.misses, info.currsize))
+        self.assertEqual(0, CategoryTransformer().cache_info().currsize)
+        self.transformer.clear_cache()
+        self.assertEqual(0, self.transformer.cache_info().currsize)
+        # Column path handles distinct texts once, without the cache.
+        rows, feaids, _ = self.transformer.transform_column(pandas.Series(["1", "2", "1"]))
+        self.assertListEqual([0, 1, 2], list(rows))
+        self.assertListEqual([0, 1, 0], list(feaids))
+        self.assertEqual(info.misses, self.transformer.cache_info().misses)
+
+class TestHashingTransformer(unittest.TestCase):
+    def test_transform(self):
+        transformer = HashingCategoryTransformer(16)
+        transformer.load(pandas.Series(["1", "2"]))
+        self.assertEqual(16, transformer.num_features)
+        features = transformer.transform(" 1 ")
+        self.assertEqual(1, len(features))
+        bucket, value = features[0]
+        self.assertTrue(0 <= bucket < 16)
+        self.assertIn(value, (1, -1))
+        self.assertListEqual(features, HashingCategoryTransformer(16).transform("1"))
+        self.assertListEqual([], transformer.transform(""))
+        self.assertRaises(ValueError, transformer.set_normalizer, MinMaxNorm())
+
+    def test_text_transform(self):
+        transformer = HashingTextTransformer(",", 1 << 20)
+        bucket, sign = transformer._bucket("a")
+        self.assertIn((bucket, 2 * sign), transformer.transform("a,b,a"))
+        self.assertEqual(2, len(transformer.transform("a,b,a")))
+        # All terms in one bucket, signs may cancel out.
+        transformer = HashingTextTransformer(",", 1)
+        self.assertEqual(sum(transformer._bucket(t)[1] for t in "abc"), sum(v for _, v in transformer.transform("a,b,c")))
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -1,13 +1,348 @@
 # coding: utf-8
-from functools import wraps
-from collections import OrderedDict
+from functools import wraps, update_wrapper
+from collections import OrderedDict, namedtuple
 import time
 import os
 import pickle
+import asyncio
+import inspect
+import sqlite3
+import threading
+import types
+import weakref
+from urllib.parse import quote
 
+from . import metrics
 
-def memory(cache_file=None, readonly=False):
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "currsize", "maxsize"])
+
+_MISSING = object()
+
+
+class Cache(object):
+    """A key-value cache with optional size bound, eviction policy and ttl.
+    Params:
+    maxsize: max number of entries, None for unbounded.
+    policy: "lru" or "lfu", which entry to evict when full.
+    ttl: seconds an entry lives, None for forever. Expired entries are dropped when looked up or by the next put.
+    Reads reorder entries, so every method holds the lock of the cache, which is safe to share across threads.
+    """
+    def __init__(self, maxsize=None, policy="lru", ttl=None):
+        if policy not in ("lru", "lfu"):
+            raise ValueError("Unsupported cache policy {}. Supported policies are: lru, lfu.".format(policy))
+        if maxsize is not None and maxsize <= 0:
+            raise ValueError("maxsize must be positive.")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        # key -> expire time, in the order of expire times since every entry lives ttl.
+        self._expires = OrderedDict()
+        # LFU bookkeeping: key -> frequency, frequency -> keys in insertion order.
+        self._freqs = dict()
+        self._buckets = dict()
+        self._min_freq = 0
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data and not self._expired(key)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def items(self):
+        with self._lock:
+            return [(key, value) for key, value in self._data.items() if not self._expired(key)]
+
+    def get(self, key, default=_MISSING):
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is not _MISSING and self._expired(key):
+                self._remove(key)
+                self.evictions += 1
+                value = _MISSING
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._touch(key)
+            return value
+
+    def peek(self, key):
+        """Return value of key without counting or touching it, _MISSING if not found.
+        """
+        with self._lock:
+            if key in self._data and not self._expired(key):
+                return self._data[key]
+            return _MISSING
+
+    def put(self, key, value):
+        with self._lock:
+            if self.ttl is not None:
+                self._purge()
+            if key in self._data:
+                self._data[key] = value
+                self._touch(key)
+            else:
+                # Make room first, a new LFU entry would be its own victim.
+                while self.maxsize is not None and len(self._data) >= self.maxsize:
+                    self._remove(self._victim())
+                    self.evictions += 1
+                self._data[key] = value
+                if self.policy == "lfu":
+                    self._freqs[key] = 1
+                    self._buckets.setdefault(1, OrderedDict())[key] = None
+                    self._min_freq = 1
+            if self.ttl is not None:
+                self._expires[key] = time.monotonic() + self.ttl
+                self._expires.move_to_end(key)
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self.shrink()
+
+    def shrink(self):
+        """Evict entries until the cache fits in maxsize.
+        """
+        with self._lock:
+            while self.maxsize is not None and len(self._data) > self.maxsize:
+                self._remove(self._victim())
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+            self._freqs.clear()
+            self._buckets.clear()
+            self._min_freq = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, len(self._data), self.maxsize)
+
+    def _purge(self):
+        """Drop expired entries, which are at the head of _expires.
+        """
+        now = time.monotonic()
+        while self._expires:
+            key, expires = next(iter(self._expires.items()))
+            if expires > now:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def _expired(self, key):
+        return self.ttl is not None and self._expires[key] <= time.monotonic()
+
+    def _touch(self, key):
+        if self.policy == "lru":
+            self._data.move_to_end(key)
+            return
+        freq = self._freqs[key]
+        bucket = self._buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[freq]
+            if self._min_freq == freq:
+                self._min_freq = freq + 1
+        self._freqs[key] = freq + 1
+        self._buckets.setdefault(freq + 1, OrderedDict())[key] = None
+
+    def _victim(self):
+        if self.policy == "lru":
+            return next(iter(self._data))
+        if self._min_freq not in self._buckets:
+            self._min_freq = min(self._buckets)
+        return next(iter(self._buckets[self._min_freq]))
+
+    def _remove(self, key):
+        del self._data[key]
+        self._expires.pop(key, None)
+        if self.policy == "lfu":
+            freq = self._freqs.pop(key)
+            bucket = self._buckets[freq]
+            del bucket[key]
+            if not bucket:
+                del self._buckets[freq]
+
+
+class SqliteCache(object):
+    """A persistent cache in a sqlite database, entries are written one by one as they come.
+    Several processes can read and write the same file, lookups only load the asked entry.
+    Params:
+    path: sqlite database file.
+    maxsize: size of an in-memory LRU cache in front of the database, None for no front cache.
+    readonly: never write to the database, which must exist.
+    """
+    def __init__(self, path, maxsize=None, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.front = Cache(maxsize) if maxsize else None
+        self.hits = 0
+        self.misses = 0
+        # sqlite connections can not be shared across threads or forked processes.
+        self._local = threading.local()
+        conn = self._connection()
+        if not readonly:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key BLOB PRIMARY KEY, value BLOB)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            if self.readonly:
+                # A plain connect would create a missing file.
+                conn = sqlite3.connect("file:{}?mode=ro".format(quote(os.path.abspath(self.path))), timeout=60,
+                                       isolation_level=None, uri=True)
+            else:
+                conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _dumps(obj):
+        return pickle.dumps(obj, protocol=4)
+
+    def __len__(self):
+        try:
+            return self._connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        except sqlite3.OperationalError:
+            return 0
+
+    def __contains__(self, key):
+        return self.get(key) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def items(self):
+        for key, value in self._connection().execute("SELECT key, value FROM cache"):
+            yield pickle.loads(key), pickle.loads(value)
+
+    def get(self, key, default=_MISSING):
+        if self.front is not None:
+            value = self.front.get(key)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+        try:
+            row = self._connection().execute("SELECT value FROM cache WHERE key = ?", (self._dumps(key),)).fetchone()
+        except sqlite3.OperationalError:
+            # Table not created yet by a writer.
+            row = None
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value = pickle.loads(row[0])
+        if self.front is not None:
+            self.front.put(key, value)
+        return value
+
+    def peek(self, key):
+        if self.front is not None:
+            value = self.front.peek(key)
+            if value is not _MISSING:
+                return value
+        try:
+            row = self._connection().execute("SELECT value FROM cache WHERE key = ?", (self._dumps(key),)).fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        return pickle.loads(row[0]) if row is not None else _MISSING
+
+    def put(self, key, value):
+        if self.front is not None:
+            self.front.put(key, value)
+        if not self.readonly:
+            self._connection().execute("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                                       (self._dumps(key), self._dumps(value)))
+
+    def resize(self, maxsize):
+        if self.front is None:
+            self.front = Cache(maxsize) if maxsize else None
+        elif maxsize:
+            self.front.resize(maxsize)
+        else:
+            self.front = None
+
+    def clear(self):
+        """Clear the front cache and the database.
+        """
+        if self.front is not None:
+            self.front.clear()
+        if not self.readonly:
+            self._connection().execute("DELETE FROM cache")
+
+    def info(self):
+        evictions = self.front.evictions if self.front is not None else 0
+        maxsize = self.front.maxsize if self.front is not None else None
+        return CacheInfo(self.hits, self.misses, evictions, len(self), maxsize)
+
+
+class _Flight(object):
+    """A computation in flight, waited on by concurrent callers of the same key.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def memory(cache_file=None, readonly=False, maxsize=None, policy="lru", ttl=None, per_instance=False, backend=None,
+           single_flight=False):
     """Used to cache function result, using cache_file to cache the results.
+    Params:
+    backend: how cache_file is kept.
+        "pickle": loaded into memory at once and dumped at exit.
+        "sqlite": a SqliteCache, entries are written as they come and looked up lazily,
+            maxsize is the size of its in-memory LRU front.
+        Default to "sqlite" if cache_file ends with ".db" or ".sqlite", else "pickle".
+    maxsize, policy, ttl: bound of the cache, see Cache.
+    per_instance: keep one cache per first argument(self for methods), keyed on the rest arguments.
+        Caches go away with their instance.
+    single_flight: concurrent calls missing the same key compute it only once, one call runs fn and the
+        others wait for its result or exception. For async functions, callers awaiting the same key share
+        one task. It costs every miss some locking, so only use it for slow calls that really race.
+    The wrapped function gets cache_info(instance=None), cache_clear(instance=None) and cache_resize(maxsize).
     Example:
     @memory
     def compute(*args):
@@ -15,27 +350,147 @@ def memory(cache_file=None, readonly=False):
     @memory("cache.txt")
     def compute(*args):
         return time_cost_compute(*args)
+    @memory("cache.db", maxsize=10000)
+    def compute(*args):
+        return time_cost_compute(*args)
+    @memory(maxsize=10000, per_instance=True)
+    def transform(self, text):
+        return time_cost_transform(text)
     """
+    if cache_file and per_instance:
+        raise ValueError("per_instance caches can not be saved to cache_file.")
+
     def saver(filename, cache):
         with open(filename, "wb") as fout:
-            pickle.dump(cache, fout)
-        
-    cache = dict()
-    if cache_file:
+            pickle.dump(dict(cache.items()), fout)
+
+    if backend is None:
+        backend = "sqlite" if cache_file and cache_file.endswith((".db", ".sqlite")) else "pickle"
+    if backend not in ("pickle", "sqlite"):
+        raise ValueError("Unsupported backend {}. Supported backends are: pickle, sqlite.".format(backend))
+
+    settings = {"maxsize": maxsize}
+    if cache_file and backend == "sqlite":
+        cache = SqliteCache(cache_file, maxsize, readonly)
+    else:
+        cache = Cache(maxsize, policy, ttl)
+    if cache_file and backend == "pickle":
         if os.path.exists(cache_file):
             with open(cache_file, "rb") as fin:
-                cache = pickle.load(fin)
+                for key, value in pickle.load(fin).items():
+                    cache.put(key, value)
         if not readonly:
             import atexit
             atexit.register(saver, cache_file, cache)
-        
+
     def main(fn):
-        @wraps(fn)
-        def wrapper(*args):
-            if args not in wrapper.cache:
-                wrapper.cache[args] = fn(*args)
-            return wrapper.cache[args]
+        caches = weakref.WeakKeyDictionary()
+        # (id of cache, key) -> _Flight of the call computing it.
+        flights = dict()
+        lock = threading.Lock()
+
+        def get_cache(args):
+            if not per_instance:
+                return cache, args
+            instance_cache = caches.get(args[0])
+            if instance_cache is None:
+                with lock:
+                    instance_cache = caches.get(args[0])
+                    if instance_cache is None:
+                        instance_cache = caches[args[0]] = Cache(settings["maxsize"], policy, ttl)
+            return instance_cache, args[1:]
+
+        def all_caches(instance):
+            if not per_instance:
+                return [cache]
+            if instance is None:
+                return list(caches.values())
+            return [caches[instance]] if instance in caches else []
+
+        def compute(args, target, key):
+            if not single_flight:
+                value = fn(*args)
+                target.put(key, value)
+                return value
+            flight_key = (id(target), key)
+            with lock:
+                # Computed while we were looking up.
+                value = target.peek(key)
+                if value is not _MISSING:
+                    return value
+                flight = flights.get(flight_key)
+                leader = flight is None
+                if leader:
+                    flight = flights[flight_key] = _Flight()
+            if not leader:
+                return flight.wait()
+            try:
+                flight.value = fn(*args)
+                with lock:
+                    target.put(key, flight.value)
+                return flight.value
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with lock:
+                    del flights[flight_key]
+                flight.event.set()
+
+        async def compute_async(args, target, key):
+            value = await fn(*args)
+            with lock:
+                target.put(key, value)
+            return value
+
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def wrapper(*args):
+                target, key = get_cache(args)
+                value = target.get(key)
+                if value is not _MISSING:
+                    return value
+                if not single_flight:
+                    return await compute_async(args, target, key)
+                flight_key = (id(asyncio.get_running_loop()), id(target), key)
+                task = flights.get(flight_key)
+                if task is None:
+                    task = flights[flight_key] = asyncio.ensure_future(compute_async(args, target, key))
+                    task.add_done_callback(lambda _: flights.pop(flight_key, None))
+                # A cancelled caller must not cancel the shared task.
+                return await asyncio.shield(task)
+        else:
+            @wraps(fn)
+            def wrapper(*args):
+                target, key = get_cache(args)
+                # Caches lock themselves, only single_flight misses take the flights lock.
+                value = target.get(key)
+                if value is _MISSING:
+                    value = compute(args, target, key)
+                return value
+
+        def cache_info(instance=None):
+            """Statistics of the cache, summed over all instances if instance is None.
+            """
+            infos = [it.info() for it in all_caches(instance)]
+            return CacheInfo(sum(it.hits for it in infos), sum(it.misses for it in infos),
+                             sum(it.evictions for it in infos), sum(it.currsize for it in infos),
+                             settings["maxsize"])
+
+        def cache_clear(instance=None):
+            for it in all_caches(instance):
+                it.clear()
+
+        def cache_resize(maxsize):
+            settings["maxsize"] = maxsize
+            for it in all_caches(None):
+                it.resize(maxsize)
+
         wrapper.cache = cache
+        wrapper.caches = caches
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_resize = cache_resize
         return wrapper
     
     return main
@@ -58,53 +513,97 @@ def collector(c_func):
     return main
 
 
-def counter(key_func):
+class _Metered(object):
+    """Callable wrapper of fn which also binds as a method.
+    """
+    def __init__(self, fn):
+        update_wrapper(self, fn)
+        self.fn = fn
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return types.MethodType(self, instance)
+
+
+class _Counted(_Metered):
+    def __init__(self, fn, key_func, maxkeys):
+        super().__init__(fn)
+        self.key_func = key_func
+        self.metric = metrics.Counter(fn.__qualname__, maxkeys)
+
+    def __call__(self, *args, **kwargs):
+        self.metric.add(self.key_func(args))
+        return self.fn(*args, **kwargs)
+
+    @property
+    def counter(self):
+        return self.metric.counts()
+
+
+def counter(key_func, maxkeys=None):
     """Count the args that call function.
+    At most maxkeys distinct keys are kept per thread, the rest are counted under metrics.OTHER_KEY.
     @counter(lambda x: x[0])
     def test(x):
         return x
     test(1)
     test(1)
     test(2)
-    test.counter([1]) -> 2
+    test.counter[1] -> 2
     """
     def main(fn):
-        @wraps(fn)
-        def wrapper(*args):
-            key = key_func(args)
-            #wrapper.counter[key] += 1
-            wrapper.counter[key] = wrapper.counter.get(key, 0) + 1
-            return fn(*args)
-        #wrapper.counter = defaultdict(lambda : 0)
-        wrapper.counter = OrderedDict()
-        return wrapper
+        return _Counted(fn, key_func, maxkeys)
     return main
 
 
+class _Timed(_Metered):
+    def __init__(self, fn):
+        super().__init__(fn)
+        self.metric = metrics.Timer(fn.__qualname__)
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return self.fn(*args, **kwargs)
+        finally:
+            self.metric.record(time.perf_counter_ns() - start)
+
+    @property
+    def cost(self):
+        return self.metric.cost
+
+
+class _YieldTimed(_Timed):
+    def __call__(self, *args, **kwargs):
+        return self._run(self.fn(*args, **kwargs))
+
+    def _run(self, gen):
+        cost = 0
+        try:
+            while True:
+                start = time.perf_counter_ns()
+                try:
+                    item = next(gen)
+                except StopIteration:
+                    return
+                finally:
+                    cost += time.perf_counter_ns() - start
+                yield item
+        finally:
+            gen.close()
+            self.metric.record(cost)
+
+
 def timer(fn):
-    """Statistic the function runtime in seconds.
+    """Statistic the function runtime.
+    fn.cost is the total runtime in seconds, fn.metric.snapshot() gives count and latency percentiles.
     """
-    def wrapper(*args):
-        start = time.time()
-        result = fn(*args)
-        end = time.time()
-        wrapper.cost += (end - start)
-        return result
-    wrapper.cost = 0
-    return wrapper
+    return _Timed(fn)
+
 
 def yield_timer(fn):
     """Statistic the function runtime in seconds.
-    For function with yield.
+    For function with yield, time between yields is not counted.
     """
-    def wrapper(*args):
-        start = time.time()
-        for i in fn(*args):
-            end = time.time()
-            wrapper.cost += end - start
-            yield i
-            start = time.time()
-        end = time.time()
-        wrapper.cost += (end - start)
-    wrapper.cost = 0
-    return wrapper
\ No newline at end of file
+    return _YieldTimed(fn)
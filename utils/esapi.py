@@ -4,16 +4,37 @@ Elasticsearch convenient functions.
 """
 from elasticsearch import Elasticsearch
 import elasticsearch.helpers
+import asyncio
+import contextlib
 import json
+import logging
+import queue
+import threading
+import time
+
+from . import decorator
+from .multiprocess import parallel_imap
+
+logger = logging.getLogger(__name__)
 
 
 class EsHelper(object):
-    def __init__(self, uri, user, password, timeout=30000):
+    def __init__(self, uri, user, password, timeout=30000, client=None, cache_size=None, cache_ttl=None):
+        """
+        Params:
+        client: use this client instead of connecting to uri, e.g. a local stand-in for tests.
+        cache_size, cache_ttl: cache results of search in an lru cache of cache_size queries, each
+            kept for cache_ttl seconds, no cache if both are None. cache_size defaults to 1024 with cache_ttl.
+        """
         self._user = user
         self._password = password
         self._uri = uri
         self._timeout = timeout
-        self._client = Elasticsearch(uri, http_auth=(user, password), timeout=timeout)
+        self._client = client if client is not None else Elasticsearch(uri, http_auth=(user, password), timeout=timeout)
+        self._search_cache = None
+        self._search_lock = threading.Lock()
+        if cache_size is not None or cache_ttl is not None:
+            self._search_cache = decorator.Cache(maxsize=cache_size or 1024, ttl=cache_ttl)
 
     def reset(self, uri, user, password, timeout):
         """reset client.
@@ -25,27 +46,99 @@ class EsHelper(object):
         if uri:
             self._uri = uri
         self._client = Elasticsearch(self._uri, http_auth=(self._user, self._password), timeout=timeout)
+        self.search_cache_clear()
 
-    def scan(self, index, query, need_id=False):
+    def scan(self, index, query, need_id=False, size=100, slices=None, workers=None, source=None):
         """Crawl fresh data.
+        Params:
+        size: number of docs per scroll request.
+        slices: split the scroll into this many slices read concurrently, hits of slices are interleaved.
+        workers: number of threads reading slices, default to slices.
+        source: _source filtering, e.g. a list of fields or False.
         """
-        for e in elasticsearch.helpers.scan(self._client, index=index, query=query, size=100, request_timeout=30000):
+        query = dict(query or {})
+        if source is not None:
+            query["_source"] = source
+        if slices and slices > 1:
+            hits = self._scan_slices(index, query, size, slices, workers or slices)
+        else:
+            hits = elasticsearch.helpers.scan(self._client, index=index, query=query, size=size, request_timeout=30000)
+        for e in hits:
             if not need_id:
                 yield e['_source']
             else:
                 yield e["_id"], e["_source"]
 
+    def _scan_slices(self, index, query, size, slices, workers):
+        """Read slices of a sliced scroll in worker threads and yield their hits as they come.
+        """
+        todo = queue.Queue()
+        for i in range(slices):
+            todo.put(dict(query, slice={"id": i, "max": slices}))
+        hits = queue.Queue(maxsize=size * workers)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    hits.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+        def work():
+            try:
+                while not stop.is_set():
+                    try:
+                        slice_query = todo.get_nowait()
+                    except queue.Empty:
+                        break
+                    for hit in elasticsearch.helpers.scan(self._client, index=index, query=slice_query, size=size,
+                                                          request_timeout=30000):
+                        if stop.is_set():
+                            break
+                        put(hit)
+            except Exception as e:
+                put(e)
+            put(done)
+
+        threads = [threading.Thread(target=work, daemon=True) for _ in range(min(workers, slices))]
+        for thread in threads:
+            thread.start()
+        try:
+            running = len(threads)
+            while running:
+                item = hits.get()
+                if item is done:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+
     @staticmethod
     def esclient(user, password, uri, timeout=30000):
         """Get the raw ES client.
         """
         return Elasticsearch(uri, http_auth=(user, password), timeout=timeout)
 
-    def backup(self, src_index, des_index, des_client, _type):
-        """Backup
+    def backup(self, src_index, des_index, des_client=None, _type=None, overwrite=True, server_side=None,
+               slices="auto", poll_interval=5):
+        """Copy src_index into des_index of des_client, default to this cluster.
+        Within one cluster the copy is a server-side _reindex task split into slices, polled every
+        poll_interval seconds until done, else docs go through this process by scroll and bulk.
+        des_index is created without replicas and refresh during the copy, its settings are restored after.
+        Params:
+        _type: only copy docs of this type.
+        overwrite: delete des_index if it exists, else raise ValueError.
+        server_side: copy by a _reindex task, default to whether des_client is connected to the same
+            cluster, by cluster_uuid.
         """
         def copy_settings(src_client, src_index):
-            valids = {"number_of_shards", "number_of_replicas"}
+            valids = {"number_of_shards", "number_of_replicas", "refresh_interval"}
             settings = src_client.indices.get_settings(index=src_index)[src_index]['settings']['index']
             settings_new = {}
             for i in valids:
@@ -56,49 +149,200 @@ class EsHelper(object):
         def copy_mappings(src_client, src_index):
             return src_client.indices.get_mapping(index=src_index)[src_index]['mappings']
 
-        des_client.indices.delete(des_index)
-        r = des_client.indices.create(index=des_index,
-                                      body={'settings': copy_settings(self._client, src_index),
-                                            "mappings": copy_mappings(self._client, src_index)})
-        
-        # Reindex 
-        body = {"query": {"term": {"_type": _type}}}
-        elasticsearch.helpers.reindex(client=self._client,
-                                      source_index=src_index,
-                                      target_index=des_index,
-                                      target_client=des_client,
-                                      query=body,
-                                      chunk_size=1024,
-                                      scroll='5m')
-
-    def search(self, index, query):
+        if des_client is None:
+            des_client = self._client
+        if server_side is None:
+            server_side = des_client is self._client or \
+                des_client.info()["cluster_uuid"] == self._client.info()["cluster_uuid"]
+        if des_client.indices.exists(index=des_index):
+            if not overwrite:
+                raise ValueError("Index {} already exists.".format(des_index))
+            des_client.indices.delete(index=des_index)
+        settings = copy_settings(self._client, src_index)
+        des_client.indices.create(index=des_index,
+                                  body={'settings': dict(settings, number_of_replicas=0, refresh_interval="-1"),
+                                        "mappings": copy_mappings(self._client, src_index)})
+
+        query = {"term": {"_type": _type}} if _type is not None else None
+        try:
+            if server_side:
+                body = {"source": {"index": src_index}, "dest": {"index": des_index}}
+                if query is not None:
+                    body["source"]["query"] = query
+                task = self._client.reindex(body=body, slices=slices, wait_for_completion=False)["task"]
+                self._wait_task(task, poll_interval)
+            else:
+                elasticsearch.helpers.reindex(client=self._client,
+                                              source_index=src_index,
+                                              target_index=des_index,
+                                              target_client=des_client,
+                                              query={"query": query} if query is not None else None,
+                                              chunk_size=1024,
+                                              scroll='5m')
+        finally:
+            des_client.indices.put_settings(index=des_index,
+                                            body={"index": {"number_of_replicas": settings.get("number_of_replicas", 1),
+                                                            "refresh_interval": settings.get("refresh_interval")}})
+
+    def _wait_task(self, task, poll_interval):
+        """Wait for task to complete, raise RuntimeError if it failed.
+        """
+        while True:
+            result = self._client.tasks.get(task_id=task)
+            if result.get("completed"):
+                break
+            status = result["task"]["status"]
+            logger.info('task=%s created=%d updated=%d total=%d' % (task, status.get("created", 0),
+                                                                    status.get("updated", 0), status.get("total", 0)))
+            time.sleep(poll_interval)
+        response = result.get("response", {})
+        if result.get("error") or response.get("failures"):
+            raise RuntimeError("Task {} failed: {}".format(task, result.get("error") or response["failures"][:10]))
+        return response
+
+    def search(self, index, query, use_cache=True):
         """Search by a query in index.
+        With a search cache, results of equal queries are shared, do not modify them.
+        """
+        if self._search_cache is None or not use_cache:
+            return [doc['_source'] for doc in self._client.search(index=index, body=query)['hits']['hits']]
+        key = (index, json.dumps(query, sort_keys=True, default=str))
+        with self._search_lock:
+            result = self._search_cache.get(key, None)
+        if result is None:
+            result = [doc['_source'] for doc in self._client.search(index=index, body=query)['hits']['hits']]
+            with self._search_lock:
+                self._search_cache.put(key, result)
+        return list(result)
+
+    def search_cache_info(self):
+        """Return CacheInfo(hits, misses, evictions, currsize, maxsize) of the search cache, None if no cache.
+        """
+        if self._search_cache is None:
+            return None
+        with self._search_lock:
+            return self._search_cache.info()
+
+    def search_cache_clear(self):
+        if self._search_cache is not None:
+            with self._search_lock:
+                self._search_cache.clear()
+
+    def search_iter(self, index, query, page_size=1000, need_id=False, keep_alive="1m"):
+        """Yield all hits of query page by page, with search_after in a point in time of index,
+        so deep pages cost as little as the first and see a consistent view of index.
+        Hits are sorted by the sort of query, default to index order.
         """
-        return [doc['_source'] for doc in self._client.search(index=index, body=query)['hits']['hits']]
-
-    def batch_upsert(self, index, _type, ids, docs):
-        """return (success number, list of errors)
-        """
-        actions = [{"_source": doc, "_id": _id, "_type": _type, "_index": index}
-                for _id, doc in zip(ids, docs)]
-        return elasticsearch.helpers.bulk(
-                self._client, actions, raise_on_error=False)
-
-    def batch_update(self, index, _type, ids, docs):
-        assert len(ids) == len(docs)
-        actions = []
-        for _id, doc in zip(ids, docs):
-            action = {
-                '_op_type': 'update',
-                '_index': index,
-                '_type': _type,
-                '_id': _id,
-                'doc': doc,
-                # If not exists, it will insert a new doc.
-                "doc_as_upsert": True
-            }
-            actions.append(action)
-        print(elasticsearch.helpers.bulk(self._client, actions))
+        body = dict(query or {})
+        body.setdefault("sort", [{"_shard_doc": "asc"}])
+        body["size"] = page_size
+        pit_id = self._client.open_point_in_time(index=index, keep_alive=keep_alive)["id"]
+        try:
+            while True:
+                body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+                result = self._client.search(body=body)
+                pit_id = result.get("pit_id", pit_id)
+                hits = result['hits']['hits']
+                for e in hits:
+                    if not need_id:
+                        yield e['_source']
+                    else:
+                        yield e["_id"], e["_source"]
+                if len(hits) < page_size:
+                    break
+                body["search_after"] = hits[-1]["sort"]
+        finally:
+            self._client.close_point_in_time(body={"id": pit_id})
+
+    def bulk(self, actions, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024, threads=1,
+             max_retries=3, initial_backoff=2, max_backoff=600, max_errors=100):
+        """Send an iterable of bulk actions, return {"success": n, "failed": n, "errors": [...]}.
+        Actions are read lazily and sent in chunks of at most chunk_size actions and about max_chunk_bytes
+        bytes, by threads concurrent bulk requests. Items rejected with 429 are retried up to max_retries
+        times, waiting initial_backoff seconds doubled every retry up to max_backoff.
+        errors holds summaries {"op", "_index", "_id", "status", "error"} of the first max_errors failed items.
+        """
+        def send(chunk):
+            result = {"success": 0, "failed": 0, "errors": []}
+            for ok, item in elasticsearch.helpers.streaming_bulk(
+                    self._client, chunk, chunk_size=len(chunk), max_chunk_bytes=max_chunk_bytes,
+                    raise_on_error=False, raise_on_exception=False, max_retries=max_retries,
+                    initial_backoff=initial_backoff, max_backoff=max_backoff):
+                if ok:
+                    result["success"] += 1
+                    continue
+                result["failed"] += 1
+                if len(result["errors"]) < max_errors:
+                    result["errors"].append(self._bulk_error(item))
+            return result
+
+        chunks = self._chunk_actions(actions, chunk_size, max_chunk_bytes)
+        if threads > 1:
+            results = parallel_imap(send, chunks, threads, ordered=False, processes=False)
+        else:
+            results = map(send, chunks)
+        summary = {"success": 0, "failed": 0, "errors": []}
+        for result in results:
+            summary["success"] += result["success"]
+            summary["failed"] += result["failed"]
+            summary["errors"].extend(result["errors"][:max_errors - len(summary["errors"])])
+        return summary
+
+    @staticmethod
+    def _chunk_actions(actions, chunk_size, max_chunk_bytes):
+        """Group actions into lists of at most chunk_size actions and about max_chunk_bytes bytes.
+        """
+        chunk = []
+        size = 0
+        for action in actions:
+            if isinstance(action, str):
+                nbytes = len(action.encode("utf-8"))
+            else:
+                nbytes = len(json.dumps(action, default=str).encode("utf-8"))
+            if chunk and (len(chunk) >= chunk_size or size + nbytes > max_chunk_bytes):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(action)
+            size += nbytes + 1
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def _bulk_error(item):
+        """Summarize a failed bulk item {op_type: info}, leaving out the document.
+        """
+        op, info = next(iter(item.items()))
+        error = info.get("error")
+        if error is None and "exception" in info:
+            error = repr(info["exception"])
+        return {"op": op, "_index": info.get("_index"), "_id": info.get("_id"),
+                "status": info.get("status"), "error": error}
+
+    @staticmethod
+    def _action(op_type, index, _type, _id, **fields):
+        action = {"_op_type": op_type, "_index": index, "_id": _id}
+        if _type is not None:
+            action["_type"] = _type
+        action.update(fields)
+        return action
+
+    def batch_upsert(self, index, _type, ids, docs, **kwargs):
+        """Index docs(any iterables) with ids, return (success number, list of error summaries).
+        kwargs are passed to bulk.
+        """
+        actions = (self._action("index", index, _type, _id, _source=doc) for _id, doc in zip(ids, docs))
+        result = self.bulk(actions, **kwargs)
+        return result["success"], result["errors"]
+
+    def batch_update(self, index, _type, ids, docs, **kwargs):
+        """Partially update docs(any iterables) with ids, docs not existing are inserted.
+        Return (success number, list of error summaries), kwargs are passed to bulk.
+        """
+        actions = (self._action("update", index, _type, _id, doc=doc, doc_as_upsert=True)
+                   for _id, doc in zip(ids, docs))
+        result = self.bulk(actions, **kwargs)
+        return result["success"], result["errors"]
 
     def build_index(self, index, mappings):
         """Build the index given the index schema(mappings).
@@ -113,3 +357,201 @@ class EsHelper(object):
         """
         self._client.indices.put_mapping(index=index, doc_type=doc_type, body=body)
 
+
+
+class AsyncEsHelper(object):
+    """EsHelper on the asyncio client, for fanning out many requests from one event loop.
+    Params:
+    maxsize: connections kept per node.
+    concurrency: max requests in flight through this helper, None for no limit.
+    client: use this client instead of connecting to uri.
+    """
+    def __init__(self, uri, user, password, timeout=30000, maxsize=10, concurrency=None, client=None):
+        self._user = user
+        self._password = password
+        self._uri = uri
+        self._timeout = timeout
+        self._maxsize = maxsize
+        self._semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+        self._inflight = dict()
+        self._closing = False
+        self._client = client if client is not None else self._connect()
+
+    def _connect(self):
+        from elasticsearch import AsyncElasticsearch
+        return AsyncElasticsearch(self._uri, http_auth=(self._user, self._password), timeout=self._timeout,
+                                  maxsize=self._maxsize)
+
+    async def reset(self, uri=None, user=None, password=None, timeout=None, maxsize=None):
+        """Switch to a new client, the old one is closed once its in-flight requests are done.
+        """
+        if user:
+            self._user = user
+        if password:
+            self._password = password
+        if uri:
+            self._uri = uri
+        if timeout:
+            self._timeout = timeout
+        if maxsize:
+            self._maxsize = maxsize
+        old, self._client = self._client, self._connect()
+        self._closing = False
+        if not self._inflight.get(old):
+            await old.close()
+
+    async def close(self):
+        """Close the current client, at once if idle, else when its in-flight requests are done.
+        Clients retired by reset close themselves when drained.
+        """
+        self._closing = True
+        if not self._inflight.get(self._client):
+            await self._client.close()
+
+    @contextlib.asynccontextmanager
+    async def _session(self, limit=True):
+        """Hold the current client, and a concurrency slot if limit, for the duration of a request.
+        """
+        if limit and self._semaphore is not None:
+            async with self._semaphore:
+                async with self._session(limit=False) as client:
+                    yield client
+            return
+        client = self._client
+        self._inflight[client] = self._inflight.get(client, 0) + 1
+        try:
+            yield client
+        finally:
+            self._inflight[client] -= 1
+            if not self._inflight[client]:
+                del self._inflight[client]
+                if client is not self._client or self._closing:
+                    await client.close()
+
+    async def search(self, index, query):
+        """Search by a query in index.
+        """
+        async with self._session() as client:
+            result = await client.search(index=index, body=query)
+        return [doc['_source'] for doc in result['hits']['hits']]
+
+    async def search_many(self, index, queries):
+        """Run queries concurrently, return their results in order.
+        """
+        return await asyncio.gather(*(self.search(index, query) for query in queries))
+
+    async def scan(self, index, query, need_id=False, size=100, slices=None, source=None):
+        """Crawl fresh data, an async generator, see EsHelper.scan.
+        A scroll holds its client until done but no concurrency slot, as it may be consumed slowly.
+        """
+        from elasticsearch.helpers import async_scan
+        query = dict(query or {})
+        if source is not None:
+            query["_source"] = source
+        async with self._session(limit=False) as client:
+            if slices and slices > 1:
+                hits = self._scan_slices(client, index, query, size, slices)
+            else:
+                hits = async_scan(client, index=index, query=query, size=size, request_timeout=30000)
+            async for e in hits:
+                if not need_id:
+                    yield e['_source']
+                else:
+                    yield e["_id"], e["_source"]
+
+    async def _scan_slices(self, client, index, query, size, slices):
+        from elasticsearch.helpers import async_scan
+        hits = asyncio.Queue(maxsize=size * slices)
+        done = object()
+
+        async def work(i):
+            try:
+                async for hit in async_scan(client, index=index, query=dict(query, slice={"id": i, "max": slices}),
+                                            size=size, request_timeout=30000):
+                    await hits.put(hit)
+            except Exception as e:
+                await hits.put(e)
+            await hits.put(done)
+
+        tasks = [asyncio.ensure_future(work(i)) for i in range(slices)]
+        try:
+            running = len(tasks)
+            while running:
+                item = await hits.get()
+                if item is done:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def bulk(self, actions, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024, concurrency=4,
+                   max_retries=3, initial_backoff=2, max_backoff=600, max_errors=100):
+        """Send an iterable or async iterable of bulk actions, at most concurrency chunks at a time.
+        Return {"success": n, "failed": n, "errors": [...]}, see EsHelper.bulk.
+        """
+        from elasticsearch.helpers import async_streaming_bulk
+        summary = {"success": 0, "failed": 0, "errors": []}
+
+        async def send(chunk):
+            async with self._session() as client:
+                async for ok, item in async_streaming_bulk(
+                        client, chunk, chunk_size=len(chunk), max_chunk_bytes=max_chunk_bytes,
+                        raise_on_error=False, raise_on_exception=False, max_retries=max_retries,
+                        initial_backoff=initial_backoff, max_backoff=max_backoff):
+                    if ok:
+                        summary["success"] += 1
+                        continue
+                    summary["failed"] += 1
+                    if len(summary["errors"]) < max_errors:
+                        summary["errors"].append(EsHelper._bulk_error(item))
+
+        async def chunks():
+            if hasattr(actions, "__aiter__"):
+                chunk = []
+                async for action in actions:
+                    chunk.append(action)
+                    if len(chunk) >= chunk_size:
+                        for part in EsHelper._chunk_actions(chunk, chunk_size, max_chunk_bytes):
+                            yield part
+                        chunk = []
+                for part in EsHelper._chunk_actions(chunk, chunk_size, max_chunk_bytes):
+                    yield part
+            else:
+                for part in EsHelper._chunk_actions(actions, chunk_size, max_chunk_bytes):
+                    yield part
+
+        pending = set()
+        try:
+            async for chunk in chunks():
+                pending.add(asyncio.ensure_future(send(chunk)))
+                if len(pending) >= concurrency:
+                    finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in finished:
+                        task.result()
+            if pending:
+                await asyncio.gather(*pending)
+                pending = set()
+        finally:
+            for task in pending:
+                task.cancel()
+        return summary
+
+    async def batch_upsert(self, index, _type, ids, docs, **kwargs):
+        """return (success number, list of error summaries)
+        """
+        actions = (EsHelper._action("index", index, _type, _id, _source=doc) for _id, doc in zip(ids, docs))
+        result = await self.bulk(actions, **kwargs)
+        return result["success"], result["errors"]
+
+    async def batch_update(self, index, _type, ids, docs, **kwargs):
+        """Partially update docs with ids, docs not existing are inserted.
+        Return (success number, list of error summaries).
+        """
+        actions = (EsHelper._action("update", index, _type, _id, doc=doc, doc_as_upsert=True)
+                   for _id, doc in zip(ids, docs))
+        result = await self.bulk(actions, **kwargs)
+        return result["success"], result["errors"]
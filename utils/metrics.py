@@ -0,0 +1,240 @@
+# coding: utf-8
+"""
+Light metrics: timers with latency histograms and bounded counters.
+
+Each thread records into its own shard, so recording takes no lock; shards are merged when a
+snapshot is taken, and folded into a retired shard when their thread ends. All metrics are
+kept(weakly) by `registry`, which snapshots and resets them in one call.
+"""
+from collections import OrderedDict
+from functools import partial
+import threading
+import weakref
+
+# Latencies below 2 ** (SUB_BITS + 1) ns get their own bucket, above that every power of two
+# is split into 2 ** SUB_BITS buckets, so a bucket is at most 1 / 2 ** SUB_BITS of its lower bound wide.
+SUB_BITS = 2
+OTHER_KEY = "__other__"
+
+
+def bucket_of(ns):
+    if ns < (1 << (SUB_BITS + 1)):
+        return ns
+    bits = ns.bit_length()
+    sub = (ns >> (bits - SUB_BITS - 1)) & ((1 << SUB_BITS) - 1)
+    return ((bits - SUB_BITS) << SUB_BITS) + sub
+
+
+def bucket_bounds(bucket):
+    """Return [lower, upper) ns of bucket.
+    """
+    if bucket < (1 << (SUB_BITS + 1)):
+        return bucket, bucket + 1
+    bits = (bucket >> SUB_BITS) + SUB_BITS
+    sub = bucket & ((1 << SUB_BITS) - 1)
+    shift = bits - SUB_BITS - 1
+    lower = ((1 << SUB_BITS) + sub) << shift
+    return lower, lower + (1 << shift)
+
+
+class _Holder(object):
+    """Thread-local owner of a shard, it goes away when its thread ends.
+    """
+    __slots__ = ("shard", "__weakref__")
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+class Sharded(object):
+    """Hold one shard per thread, created by factory on first use in the thread.
+    When a thread ends its shard is folded into a retired shard by merge(retired, shard),
+    so there are never more shards than live threads plus one.
+    """
+    def __init__(self, factory, merge):
+        self._factory = factory
+        self._merge = merge
+        self._local = threading.local()
+        self._shards = dict()
+        self._retired = factory()
+        self._lock = threading.Lock()
+
+    def shard(self):
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            holder = _Holder(self._factory())
+            with self._lock:
+                self._shards[id(holder.shard)] = holder.shard
+            weakref.finalize(holder, Sharded._retire, weakref.ref(self), holder.shard)
+            self._local.holder = holder
+        return holder.shard
+
+    @staticmethod
+    def _retire(ref, shard):
+        self = ref()
+        if self is None:
+            return
+        with self._lock:
+            self._merge(self._retired, shard)
+            del self._shards[id(shard)]
+
+    def shards(self):
+        with self._lock:
+            return list(self._shards.values()) + [self._retired]
+
+
+class _TimerShard(object):
+    __slots__ = ("count", "total_ns", "max_ns", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.buckets = dict()
+
+    def merge(self, other):
+        self.count += other.count
+        self.total_ns += other.total_ns
+        self.max_ns = max(self.max_ns, other.max_ns)
+        for bucket, n in list(other.buckets.items()):
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + n
+
+
+class Timer(object):
+    """Count calls and keep a histogram of their latencies in nanoseconds.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._sharded = Sharded(_TimerShard, _TimerShard.merge)
+        registry.add(self)
+
+    def record(self, ns):
+        shard = self._sharded.shard()
+        shard.count += 1
+        shard.total_ns += ns
+        if ns > shard.max_ns:
+            shard.max_ns = ns
+        bucket = bucket_of(ns)
+        shard.buckets[bucket] = shard.buckets.get(bucket, 0) + 1
+
+    @property
+    def cost(self):
+        """Total seconds recorded.
+        """
+        return sum(shard.total_ns for shard in self._sharded.shards()) / 1e9
+
+    def percentile(self, buckets, count, q):
+        """Return estimated latency ns of quantile q in (0, 1], the middle of its bucket.
+        """
+        rank = q * count
+        seen = 0
+        for bucket in sorted(buckets):
+            seen += buckets[bucket]
+            if seen >= rank:
+                lower, upper = bucket_bounds(bucket)
+                return (lower + upper - 1) / 2
+        return None
+
+    def snapshot(self):
+        count = 0
+        total_ns = 0
+        max_ns = 0
+        buckets = dict()
+        for shard in self._sharded.shards():
+            count += shard.count
+            total_ns += shard.total_ns
+            max_ns = max(max_ns, shard.max_ns)
+            for bucket, n in list(shard.buckets.items()):
+                buckets[bucket] = buckets.get(bucket, 0) + n
+        result = {"count": count, "total_seconds": total_ns / 1e9}
+        if count:
+            result.update(mean_ns=total_ns / count, max_ns=max_ns,
+                          p50_ns=self.percentile(buckets, count, 0.5),
+                          p95_ns=self.percentile(buckets, count, 0.95),
+                          p99_ns=self.percentile(buckets, count, 0.99))
+        return result
+
+    def reset(self):
+        for shard in self._sharded.shards():
+            shard.count = 0
+            shard.total_ns = 0
+            shard.max_ns = 0
+            shard.buckets = dict()
+
+
+def _merge_counts(maxkeys, retired, counts):
+    """Fold counts of a dead thread into retired, keeping at most maxkeys keys.
+    """
+    for key, n in list(counts.items()):
+        if key not in retired and maxkeys is not None and len(retired) >= maxkeys:
+            key = OTHER_KEY
+        retired[key] = retired.get(key, 0) + n
+
+
+class Counter(object):
+    """Count keys, at most maxkeys distinct keys per thread, the rest are counted under OTHER_KEY.
+    """
+    def __init__(self, name, maxkeys=None):
+        self.name = name
+        self.maxkeys = maxkeys
+        self._sharded = Sharded(OrderedDict, partial(_merge_counts, maxkeys))
+        registry.add(self)
+
+    def add(self, key, n=1):
+        counts = self._sharded.shard()
+        if key not in counts and self.maxkeys is not None and len(counts) >= self.maxkeys:
+            key = OTHER_KEY
+        counts[key] = counts.get(key, 0) + n
+
+    def counts(self):
+        merged = OrderedDict()
+        for counts in self._sharded.shards():
+            for key, n in list(counts.items()):
+                merged[key] = merged.get(key, 0) + n
+        return merged
+
+    def snapshot(self):
+        return dict(self.counts())
+
+    def reset(self):
+        for counts in self._sharded.shards():
+            counts.clear()
+
+
+class Registry(object):
+    """Weakly keep all metrics, metrics go away with whatever holds them.
+    """
+    def __init__(self):
+        self._metrics = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def add(self, metric):
+        with self._lock:
+            self._metrics.add(metric)
+
+    def metrics(self):
+        with self._lock:
+            return sorted(self._metrics, key=lambda metric: metric.name)
+
+    def snapshot(self, reset=False):
+        """Return {name: snapshot} of all metrics, duplicate names get suffix "#2", "#3"...
+        Reset metrics after the snapshot if reset.
+        """
+        result = dict()
+        for metric in self.metrics():
+            name = metric.name
+            i = 1
+            while name in result:
+                i += 1
+                name = "{}#{}".format(metric.name, i)
+            result[name] = metric.snapshot()
+            if reset:
+                metric.reset()
+        return result
+
+    def reset(self):
+        for metric in self.metrics():
+            metric.reset()
+
+
+registry = Registry()
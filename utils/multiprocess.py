@@ -1,10 +1,15 @@
 # coding: utf-8
 from functools import wraps
+import codecs
+import io
 import os
 import math
+import shutil
 import logging
 import traceback
-import logging
+import threading
+import queue
+from collections import deque
 
 logger = logging.getLogger(__name__)
 
@@ -16,13 +21,114 @@ def argmerge(fn):
     return wrapper
 
 
-def merge_file(concurrency, split_path_pattern, fout):
-    for i in range(concurrency):
-        path = split_path_pattern % i
-        with open(path, "r", encoding='utf-8') as fin:
-            for line in fin:
-                fout.write(line[:-1] + "\n")
+COPY_BUFSIZE = 1 << 20
+
+
+def _copy_fd(fin, out_fd, size):
+    """Copy size bytes from fin to out_fd in kernel, return False if not supported.
+    """
+    in_fd = fin.fileno()
+    for copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+        if copy is None:
+            continue
+        try:
+            copied = 0
+            while copied < size:
+                if copy is os.sendfile:
+                    n = copy(out_fd, in_fd, copied, size - copied)
+                else:
+                    n = copy(in_fd, out_fd, size - copied, copied)
+                if n == 0:
+                    break
+                copied += n
+            if copied == size:
+                return True
+        except OSError:
+            pass
+        if copied:
+            # Partially copied, finish with a plain copy.
+            fin.seek(copied)
+            with os.fdopen(os.dup(out_fd), "wb", closefd=True) as fout:
+                shutil.copyfileobj(fin, fout, COPY_BUFSIZE)
+            return True
+    return False
+
+
+def _merge_files(paths, fout):
+    binary = fout
+    if isinstance(fout, io.TextIOBase):
+        fout.flush()
+        binary = getattr(fout, "buffer", None)
+        # Split files are utf-8, other encodings are written through fout to be encoded.
+        encoding = getattr(fout, "encoding", None)
+        if not encoding or codecs.lookup(encoding).name != "utf-8":
+            binary = None
+    # Only a plain file may be written through its descriptor, e.g. not a gzip file.
+    real_file = isinstance(binary, (io.FileIO, io.BufferedWriter, io.BufferedRandom))
+    for path in paths:
+        size = os.path.getsize(path)
+        with open(path, "rb") as fin:
+            last = b""
+            if size:
+                fin.seek(size - 1)
+                last = fin.read(1)
+                fin.seek(0)
+            if binary is None:
+                decoder = codecs.getincrementaldecoder("utf-8")()
+                for block in iter(lambda: fin.read(COPY_BUFSIZE), b""):
+                    fout.write(decoder.decode(block))
+                fout.write(decoder.decode(b"", final=True))
+            elif real_file:
+                binary.flush()
+                if not _copy_fd(fin, binary.fileno(), size):
+                    shutil.copyfileobj(fin, binary, COPY_BUFSIZE)
+            else:
+                shutil.copyfileobj(fin, binary, COPY_BUFSIZE)
+        if last and last != b"\n":
+            if binary is None:
+                fout.write("\n")
+            else:
+                binary.write(b"\n")
         os.remove(path)
+    if binary is not None:
+        binary.flush()
+
+
+class _MergeThread(threading.Thread):
+    """Thread merging files, join raises the exception the merge failed with.
+    """
+    def __init__(self, paths, fout):
+        super().__init__()
+        self.paths = paths
+        self.fout = fout
+        self.error = None
+
+    def run(self):
+        try:
+            _merge_files(self.paths, self.fout)
+        except BaseException as e:
+            self.error = e
+
+    def join(self, timeout=None):
+        super().join(timeout)
+        if self.error is not None and not self.is_alive():
+            raise self.error
+
+
+def merge_file(concurrency, split_path_pattern, fout, background=False):
+    """Append split files split_path_pattern % i, i in [0, concurrency), to fout in order and remove them.
+    Files are copied as bytes in large blocks, in kernel when fout is a plain file. A text fout of another
+    encoding than utf-8 gets decoded blocks to encode. A file whose last line lacks a newline gets one.
+    Params:
+    background: merge in a thread and return it, fout must not be used until the thread is joined.
+        join raises the exception the merge failed with.
+    """
+    paths = [split_path_pattern % i for i in range(concurrency)]
+    if background:
+        thread = _MergeThread(paths, fout)
+        thread.start()
+        return thread
+    _merge_files(paths, fout)
 
 @argmerge
 def worker_file(pid, fn, args, concurrency, split_path_pattern):
@@ -33,11 +139,118 @@ def worker_file(pid, fn, args, concurrency, split_path_pattern):
                 logger.info('pid=%d num=%d/id=%d' % (pid, num, i-num*pid+1))
             fn(fout, *args[i])
 
-def scheduler_file(fn, args, concurrency, split_path_pattern, fout):
+def worker_chunk(args):
+    """Run fn over one chunk of args into its own split file, return (worker, chunk id, number of args).
+    """
+    chunk_id, fn, chunk, split_path_pattern = args
+    with open(split_path_pattern % chunk_id, 'w', encoding='utf-8') as fout:
+        for arg in chunk:
+            fn(fout, *arg)
+    return "%d-%s" % (os.getpid(), threading.current_thread().name), chunk_id, len(chunk)
+
+
+def scheduler_chunks(fn, args, concurrency, split_path_pattern, fout, processes=False, chunksize=None):
+    """Hand out small chunks of args to idle workers, so one slow chunk does not stall the rest.
+    Output is merged into fout in the order of args. A worker exception is raised after
+    removing the split files.
+    Params:
+    processes: use processes for CPU bound fn(fn must be picklable), else threads.
+    chunksize: number of args in a chunk, default to about 4 chunks per worker.
+    """
+    if processes:
+        from multiprocessing import Pool
+    else:
+        from multiprocessing.dummy import Pool
+    if not chunksize:
+        chunksize = max(1, int(math.ceil(len(args) / float(concurrency * 4))))
+    chunks = [(i, fn, args[start:start + chunksize], split_path_pattern)
+              for i, start in enumerate(range(0, len(args), chunksize))]
+
+    done = 0
+    worker_done = dict()
+    pool = Pool(concurrency)
+    try:
+        for worker, chunk_id, num in pool.imap_unordered(worker_chunk, chunks):
+            done += num
+            worker_done[worker] = worker_done.get(worker, 0) + num
+            logger.info('worker=%s chunk=%d worker_done=%d done=%d/%d' % (worker, chunk_id, worker_done[worker], done, len(args)))
+    except BaseException:
+        pool.terminate()
+        # Threads finish their running chunk, so wait for them before removing split files.
+        pool.join()
+        for i in range(len(chunks)):
+            if os.path.exists(split_path_pattern % i):
+                os.remove(split_path_pattern % i)
+        raise
+    finally:
+        pool.close()
+        pool.join()
+    merge_file(len(chunks), split_path_pattern, fout)
+
+
+def scheduler_file(fn, args, concurrency, split_path_pattern, fout, processes=False, chunksize=None):
+    """Run fn(fout_of_split, *arg) for every arg in args with concurrency workers, merge outputs into fout.
+    By default threads take fixed contiguous ranges of args and errors are only logged, see
+    scheduler_chunks for processes or chunksize.
+    """
+    if processes or chunksize:
+        return scheduler_chunks(fn, args, concurrency, split_path_pattern, fout, processes, chunksize)
     from multiprocessing.dummy import Pool
     pool = Pool(concurrency)
     try:
         pool.map(worker_file, [(i, fn, args, concurrency, split_path_pattern) for i in range(concurrency)])
     except:
         logger.error(traceback.format_exc())
-    merge_file(concurrency, split_path_pattern, fout)
\ No newline at end of file
+    merge_file(concurrency, split_path_pattern, fout)
+
+
+#------------------streaming------------------------------
+def parallel_imap(fn, iterable, workers, ordered=True, max_inflight=None, processes=True,
+                  initializer=None, initargs=()):
+    """Yield fn(item) for items of iterable computed by a pool of workers.
+    The iterable is consumed lazily, at most max_inflight items are being computed or waiting to be
+    yielded, so memory stays bounded for unbounded iterables. A worker exception is raised here.
+    Params:
+    ordered: yield results in input order, else as soon as they complete.
+    max_inflight: default to 2 * workers.
+    processes: use processes for CPU bound fn(fn and items must be picklable), else threads.
+    initializer, initargs: called once in every worker.
+    """
+    if processes:
+        from multiprocessing import Pool
+    else:
+        from multiprocessing.dummy import Pool
+    max_inflight = max_inflight or 2 * workers
+    pool = Pool(workers, initializer, initargs)
+    try:
+        if ordered:
+            pending = deque()
+            for item in iterable:
+                pending.append(pool.apply_async(fn, (item,)))
+                if len(pending) >= max_inflight:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        else:
+            done = queue.Queue()
+            inflight = 0
+
+            def next_done():
+                ok, result = done.get()
+                if not ok:
+                    raise result
+                return result
+
+            for item in iterable:
+                pool.apply_async(fn, (item,), callback=lambda result: done.put((True, result)),
+                                 error_callback=lambda e: done.put((False, e)))
+                inflight += 1
+                if inflight >= max_inflight:
+                    inflight -= 1
+                    yield next_done()
+            while inflight:
+                inflight -= 1
+                yield next_done()
+    finally:
+        pool.terminate()
+        pool.join()
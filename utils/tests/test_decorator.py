@@ -0,0 +1,270 @@
+# coding: utf-8
+import asyncio
+import multiprocessing
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from utils.decorator import Cache, SqliteCache, memory, counter, timer, yield_timer
+
+
+def hammer(fn, threads=8):
+    """Run fn(i) in threads at once, return exceptions raised.
+    """
+    errors = []
+    barrier = threading.Barrier(threads)
+
+    def run(i):
+        barrier.wait()
+        try:
+            fn(i)
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return errors
+
+
+class TestCache(unittest.TestCase):
+    def test_lru(self):
+        cache = Cache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.put("c", 3)
+        self.assertNotIn("b", cache)
+        self.assertEqual((1, 0, 1, 2, 2), tuple(cache.info()))
+
+    def test_lfu(self):
+        cache = Cache(2, policy="lfu")
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+        cache.put("c", 3)
+        self.assertListEqual(["a", "c"], sorted(key for key, _ in cache.items()))
+
+    def test_ttl(self):
+        cache = Cache(ttl=0.2)
+        for i in range(100):
+            cache.put(i, i)
+        time.sleep(0.12)
+        # Putting again renews the entry.
+        cache.put(0, 0)
+        cache.put("a", 1)
+        time.sleep(0.12)
+        # Expired entries are dropped by put, even if never looked up again.
+        cache.put("b", 2)
+        self.assertListEqual([0, "a", "b"], [key for key, _ in cache.items()])
+        self.assertEqual((3, 99), (len(cache), cache.evictions))
+
+    def test_pickle(self):
+        cache = pickle.loads(pickle.dumps(Cache(2)))
+        cache.put("a", 1)
+        self.assertEqual(1, cache["a"])
+
+    def test_threads(self):
+        for policy in ("lru", "lfu"):
+            cache = Cache(8, policy=policy)
+
+            def run(i):
+                for j in range(5000):
+                    key = (i * 7 + j) % 16
+                    if cache.get(key, None) is None:
+                        cache.put(key, j)
+
+            self.assertListEqual([], hammer(run))
+            self.assertEqual(8, len(cache))
+
+
+def put_range(path, start):
+    cache = SqliteCache(path)
+    for i in range(start, start + 50):
+        cache.put(i, i * i)
+
+
+class TestSqliteCache(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "cache.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_persistence(self):
+        cache = SqliteCache(self.path)
+        cache.put(("a", 1), [1, 2])
+        self.assertEqual(1, len(cache))
+
+        calls = []
+
+        @memory(self.path)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual(4, square(2))
+        # A later run reads entries written before.
+        cache = SqliteCache(self.path)
+        self.assertListEqual([1, 2], cache[("a", 1)])
+        self.assertEqual(4, cache[(2,)])
+        self.assertNotIn("b", cache)
+        self.assertEqual((2, 1), (cache.info().hits, cache.info().misses))
+
+    def test_readonly(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            SqliteCache(self.path, readonly=True)
+        self.assertFalse(os.path.exists(self.path))
+
+        SqliteCache(self.path).put("a", 1)
+        cache = SqliteCache(self.path, maxsize=10, readonly=True)
+        self.assertEqual(1, cache["a"])
+        cache.put("b", 2)
+        cache.clear()
+        self.assertEqual(1, SqliteCache(self.path)["a"])
+        self.assertNotIn("b", SqliteCache(self.path))
+
+    def test_front(self):
+        cache = SqliteCache(self.path, maxsize=2)
+        for key in ["a", "b", "c"]:
+            cache.put(key, key)
+        self.assertEqual(1, cache.front.evictions)
+        self.assertNotIn("a", cache.front)
+        # Evicted entries are still in the database, and come back to the front.
+        self.assertEqual("a", cache["a"])
+        self.assertIn("a", cache.front)
+        self.assertEqual((1, 0, 2, 3, 2), tuple(cache.info()))
+
+    def test_processes(self):
+        cache = SqliteCache(self.path)
+        processes = [multiprocessing.Process(target=put_range, args=(self.path, i * 50)) for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertListEqual([0] * 4, [process.exitcode for process in processes])
+        self.assertEqual(200, len(cache))
+        self.assertDictEqual({i: i * i for i in range(200)}, dict(cache.items()))
+
+
+class TestMeters(unittest.TestCase):
+    def test_counter(self):
+        @counter(lambda args: args[0])
+        def fn(x):
+            return x
+
+        fn(1)
+        fn(1)
+        fn(2)
+        self.assertEqual(2, fn.counter[1])
+        self.assertEqual(1, fn.counter[2])
+
+    def test_timer(self):
+        class Worker(object):
+            @timer
+            def work(self, x):
+                time.sleep(0.01)
+                return x
+
+        self.assertEqual(3, Worker().work(3))
+        self.assertGreaterEqual(Worker.work.cost, 0.01)
+        self.assertEqual(1, Worker.work.metric.snapshot()["count"])
+
+    def test_yield_timer(self):
+        @yield_timer
+        def gen():
+            for i in range(3):
+                time.sleep(0.01)
+                yield i
+
+        for _ in gen():
+            time.sleep(0.05)
+        self.assertGreaterEqual(gen.cost, 0.03)
+        self.assertLess(gen.cost, 0.15)
+
+
+class TestMemory(unittest.TestCase):
+    def test_cache(self):
+        calls = []
+
+        @memory(maxsize=2)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual(4, square(2))
+        self.assertEqual(4, square(2))
+        self.assertListEqual([2], calls)
+        self.assertEqual((1, 1, 0, 1, 2), tuple(square.cache_info()))
+
+    def test_threads(self):
+        for policy in ("lru", "lfu"):
+            @memory(maxsize=8, policy=policy)
+            def double(x):
+                return x * 2
+
+            def run(i):
+                for j in range(3000):
+                    key = (i * 7 + j) % 16
+                    self.assertEqual(key * 2, double(key))
+
+            self.assertListEqual([], hammer(run))
+
+    def test_single_flight(self):
+        calls = []
+
+        @memory(single_flight=True)
+        def slow(x):
+            calls.append(x)
+            time.sleep(0.1)
+            if x < 0:
+                raise ValueError(x)
+            return x
+
+        results = []
+        self.assertListEqual([], hammer(lambda i: results.append(slow(1))))
+        self.assertListEqual([1] * 8, results)
+        self.assertListEqual([1], calls)
+
+        errors = hammer(lambda i: slow(-1))
+        self.assertEqual(8, len(errors))
+        self.assertTrue(all(isinstance(e, ValueError) for e in errors))
+        self.assertListEqual([1, -1], calls)
+
+        # Racing misses each run fn without single_flight.
+        @memory()
+        def fast(x):
+            calls.append(x)
+            time.sleep(0.1)
+            return x
+
+        self.assertListEqual([], hammer(lambda i: fast(2)))
+        self.assertEqual(8, calls.count(2))
+
+    def test_async(self):
+        calls = []
+
+        @memory(maxsize=10, single_flight=True)
+        async def slow(x):
+            calls.append(x)
+            await asyncio.sleep(0.05)
+            return x
+
+        async def main():
+            results = await asyncio.gather(*[slow(i % 2) for i in range(10)])
+            results.append(await slow(1))
+            return results
+
+        self.assertListEqual([0, 1] * 5 + [1], asyncio.run(main()))
+        self.assertListEqual([0, 1], calls)
+        self.assertEqual(1, slow.cache_info().hits)
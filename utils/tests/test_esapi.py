@@ -0,0 +1,423 @@
+# coding: utf-8
+import asyncio
+import itertools
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+from urllib.parse import unquote
+
+from elasticsearch import Elasticsearch
+from elasticsearch.connection import Connection
+
+from utils.esapi import EsHelper, AsyncEsHelper
+
+
+class Cluster(object):
+    """In-memory state behind StubConnection.
+    """
+    def __init__(self, docs, uuid="stub"):
+        # Index -> list of (id, source).
+        self.docs = docs
+        self.uuid = uuid
+        # Index -> index settings.
+        self.settings = {index: {"number_of_shards": "1", "number_of_replicas": "1"} for index in docs}
+        self.tasks = dict()
+        self.scrolls = dict()
+        # Open point in time id -> index, a search answers with a new id.
+        self.pits = dict()
+        self.pit_searches = 0
+        self.cleared = set()
+        # Bulk items of these ids get 429 as many times as their value, or a 400 if in bad_ids.
+        self.rejects = dict()
+        self.bad_ids = set()
+        self.bulks = []
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+
+class StubConnection(Connection):
+    """A connection answering the few APIs EsHelper uses from a Cluster, instead of going to a server.
+    """
+    def __init__(self, cluster=None, **kwargs):
+        super().__init__(**kwargs)
+        self.cluster = cluster
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        body = body.decode("utf-8") if isinstance(body, bytes) else body
+        path = [unquote(part) for part in url.strip("/").split("/")]
+        if url == "/":
+            result = {"version": {"number": "7.17.0", "build_flavor": "default"},
+                      "tagline": "You Know, for Search", "cluster_uuid": self.cluster.uuid}
+        elif url == "/_search/scroll" and method == "DELETE":
+            scroll_ids = json.loads(body)["scroll_id"]
+            with self.cluster.lock:
+                self.cluster.cleared.update([scroll_ids] if isinstance(scroll_ids, str) else scroll_ids)
+            result = {}
+        elif url == "/_search/scroll":
+            result = self._page(json.loads(body)["scroll_id"])
+        elif url == "/_search":
+            result = self._pit_search(json.loads(body))
+        elif url == "/_pit" and method == "DELETE":
+            with self.cluster.lock:
+                del self.cluster.pits[json.loads(body)["id"]]
+            result = {"succeeded": True}
+        elif url.endswith("/_search"):
+            result = self._search(url.split("/")[1], json.loads(body))
+        elif url == "/_bulk":
+            result = self._bulk([json.loads(line) for line in body.splitlines()])
+        elif url == "/_reindex":
+            result = self._reindex(json.loads(body))
+        elif path[0] == "_data_stream":
+            self._raise_error(404, "{}")
+        elif path[0] == "_tasks":
+            result = self._task(path[1])
+        elif len(path) == 2 and path[1] == "_pit":
+            result = {"id": self._new_pit(path[0])}
+        elif len(path) == 1:
+            result = self._index(method, path[0], body)
+        elif path[1] == "_settings" and method == "PUT":
+            self.cluster.settings[path[0]].update(json.loads(body)["index"])
+            result = {"acknowledged": True}
+        elif path[1] == "_settings":
+            result = {path[0]: {"settings": {"index": self.cluster.settings[path[0]]}}}
+        elif path[1] == "_mapping":
+            result = {path[0]: {"mappings": {}}}
+        else:
+            raise ValueError("Unsupported request {} {}".format(method, url))
+        return 200, {"x-elastic-product": "Elasticsearch"}, json.dumps(result)
+
+    def _search(self, index, body):
+        hits = []
+        for i, (_id, source) in enumerate(self.cluster.docs[index]):
+            if "slice" in body and i % body["slice"]["max"] != body["slice"]["id"]:
+                continue
+            if "_source" in body:
+                source = {key: value for key, value in source.items() if key in body["_source"]}
+            hits.append({"_index": index, "_id": _id, "_source": source})
+        scroll_id = "scroll-{}".format(next(self.cluster.ids))
+        with self.cluster.lock:
+            self.cluster.scrolls[scroll_id] = (hits, body.get("size", 10))
+        return self._page(scroll_id)
+
+    def _page(self, scroll_id):
+        with self.cluster.lock:
+            hits, size = self.cluster.scrolls[scroll_id]
+            self.cluster.scrolls[scroll_id] = (hits[size:], size)
+        return {"_scroll_id": scroll_id, "_shards": {"total": 1, "successful": 1}, "hits": {"hits": hits[:size]}}
+
+    def _new_pit(self, index):
+        pit_id = "pit-{}".format(next(self.cluster.ids))
+        with self.cluster.lock:
+            self.cluster.pits[pit_id] = index
+        return pit_id
+
+    def _pit_search(self, body):
+        # Only the latest id of a point in time is valid.
+        with self.cluster.lock:
+            index = self.cluster.pits.pop(body["pit"]["id"])
+            self.cluster.pit_searches += 1
+        start = body["search_after"][0] + 1 if "search_after" in body else 0
+        hits = [{"_index": index, "_id": _id, "_source": source, "sort": [i]}
+                for i, (_id, source) in enumerate(self.cluster.docs[index])][start:start + body["size"]]
+        return {"pit_id": self._new_pit(index), "hits": {"hits": hits}}
+
+    def _bulk(self, lines):
+        items = []
+        with self.cluster.lock:
+            self.cluster.bulks.append(len(lines) // 2)
+            for action, doc in zip(lines[::2], lines[1::2]):
+                op, meta = next(iter(action.items()))
+                info = {"_index": meta["_index"], "_id": meta["_id"]}
+                if self.cluster.rejects.get(meta["_id"]):
+                    self.cluster.rejects[meta["_id"]] -= 1
+                    info.update(status=429, error={"type": "es_rejected_execution_exception"})
+                elif meta["_id"] in self.cluster.bad_ids:
+                    info.update(status=400, error={"type": "mapper_parsing_exception"})
+                else:
+                    source = doc["doc"] if op == "update" else doc
+                    self.cluster.docs.setdefault(meta["_index"], []).append((meta["_id"], source))
+                    info.update(status=201)
+                items.append({op: info})
+        return {"errors": any(info["status"] >= 300 for item in items for info in item.values()), "items": items}
+
+    def _index(self, method, index, body):
+        if method == "HEAD":
+            if index not in self.cluster.settings:
+                self._raise_error(404, "{}")
+        elif method == "DELETE":
+            del self.cluster.settings[index]
+            del self.cluster.docs[index]
+        elif method == "PUT":
+            self.cluster.settings[index] = json.loads(body)["settings"]
+            self.cluster.docs[index] = []
+        return {"acknowledged": True}
+
+    def _reindex(self, body):
+        docs = self.cluster.docs[body["source"]["index"]]
+        self.cluster.docs[body["dest"]["index"]].extend(docs)
+        task = "node:{}".format(next(self.cluster.ids))
+        # Done at the second poll.
+        self.cluster.tasks[task] = 2
+        return {"task": task}
+
+    def _task(self, task):
+        self.cluster.tasks[task] -= 1
+        if self.cluster.tasks[task]:
+            return {"completed": False, "task": {"status": {"created": 1, "total": 2}}}
+        return {"completed": True, "task": {"status": {}}, "response": {"failures": []}}
+
+
+def stub_helper(cluster, **kwargs):
+    client = Elasticsearch("http://stub:9200", connection_class=StubConnection, cluster=cluster)
+    return EsHelper("http://stub:9200", "user", "password", client=client, **kwargs)
+
+
+class TestScan(unittest.TestCase):
+    def setUp(self):
+        self.docs = [(str(i), {"n": i, "text": "doc {}".format(i)}) for i in range(23)]
+        self.cluster = Cluster({"test": self.docs})
+        self.es = stub_helper(self.cluster)
+
+    def test_scan(self):
+        self.assertListEqual([source for _, source in self.docs], list(self.es.scan("test", {}, size=5)))
+        self.assertListEqual(self.docs, list(self.es.scan("test", {}, need_id=True, size=5)))
+
+    def test_source(self):
+        self.assertListEqual([{"n": i} for i in range(23)], list(self.es.scan("test", {}, size=5, source=["n"])))
+
+    def test_slices(self):
+        for workers in (None, 2):
+            hits = list(self.es.scan("test", {}, need_id=True, size=2, slices=4, workers=workers, source=["n"]))
+            self.assertListEqual([(_id, {"n": source["n"]}) for _id, source in self.docs], sorted(hits, key=lambda hit: hit[1]["n"]))
+
+    def test_close(self):
+        hits = self.es.scan("test", {}, size=1, slices=4)
+        next(hits)
+        hits.close()
+        # Workers stop and clear their scrolls.
+        deadline = time.monotonic() + 5
+        while self.cluster.cleared != set(self.cluster.scrolls) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(4, len(self.cluster.scrolls))
+        self.assertSetEqual(set(self.cluster.scrolls), self.cluster.cleared)
+
+    def test_search_iter(self):
+        self.assertListEqual([source for _, source in self.docs], list(self.es.search_iter("test", {}, page_size=5)))
+        # 4 full pages and a last short one, each with the id of the page before.
+        self.assertEqual(5, self.cluster.pit_searches)
+        self.assertDictEqual({}, self.cluster.pits)
+        self.assertListEqual(self.docs, list(self.es.search_iter("test", {}, page_size=23, need_id=True)))
+        self.assertDictEqual({}, self.cluster.pits)
+
+        hits = self.es.search_iter("test", {}, page_size=5)
+        next(hits)
+        self.assertEqual(1, len(self.cluster.pits))
+        hits.close()
+        self.assertDictEqual({}, self.cluster.pits)
+
+    def test_search_cache(self):
+        es = stub_helper(self.cluster, cache_size=2)
+        query = {"query": {"match_all": {}}, "size": 3}
+        result = es.search("test", query)
+        self.assertListEqual([source for _, source in self.docs[:3]], result)
+        result.append(None)
+        # Key order does not matter, results are copies.
+        self.assertListEqual([source for _, source in self.docs[:3]], es.search("test", {"size": 3, "query": {"match_all": {}}}))
+        es.search("test", {"size": 4})
+        es.search("test", {"size": 5})
+        self.assertEqual((1, 3, 1, 2, 2), tuple(es.search_cache_info()))
+        es.search("test", query, use_cache=False)
+        self.assertEqual(1, es.search_cache_info().hits)
+        es.search_cache_clear()
+        self.assertEqual(0, es.search_cache_info().currsize)
+
+        es = stub_helper(self.cluster, cache_ttl=60)
+        self.assertEqual(1024, es.search_cache_info().maxsize)
+
+
+class TestBulk(unittest.TestCase):
+    def setUp(self):
+        self.cluster = Cluster(dict())
+        self.es = stub_helper(self.cluster)
+
+    def test_chunk_actions(self):
+        actions = [{"_id": i, "text": "x" * 10} for i in range(10)]
+        self.assertListEqual([4, 4, 2], [len(chunk) for chunk in EsHelper._chunk_actions(actions, 4, 1 << 20)])
+        self.assertListEqual([3, 3, 3, 1], [len(chunk) for chunk in EsHelper._chunk_actions(actions, 4, 100)])
+        self.assertListEqual([1] * 10, [len(chunk) for chunk in EsHelper._chunk_actions(actions, 4, 10)])
+
+    def test_bulk(self):
+        self.cluster.rejects = {"3": 1, "150": 2}
+        self.cluster.bad_ids = {str(i) for i in range(0, 1000, 100)}
+        consumed = []
+
+        def actions():
+            for i in range(1000):
+                consumed.append(i)
+                yield {"_index": "test", "_id": str(i), "_source": {"n": i}}
+
+        result = self.es.bulk(actions(), chunk_size=100, threads=4, initial_backoff=0, max_errors=5)
+        self.assertEqual(990, result["success"])
+        self.assertEqual(10, result["failed"])
+        self.assertEqual(5, len(result["errors"]))
+        self.assertDictEqual({"op": "index", "_index": "test", "_id": result["errors"][0]["_id"], "status": 400,
+                              "error": {"type": "mapper_parsing_exception"}}, result["errors"][0])
+        self.assertEqual(990, len(self.cluster.docs["test"]))
+        # Rejected items were sent again, once for "3" and twice for "150".
+        self.assertEqual(10 + 3, len(self.cluster.bulks))
+        self.assertEqual(1000, len(consumed))
+
+    def test_retries_exhausted(self):
+        self.cluster.rejects = {"1": 10}
+        result = self.es.bulk(({"_index": "test", "_id": str(i), "_source": {}} for i in range(3)),
+                              max_retries=2, initial_backoff=0)
+        self.assertEqual(2, result["success"])
+        self.assertListEqual([429], [error["status"] for error in result["errors"]])
+
+    def test_batch(self):
+        success, errors = self.es.batch_upsert("test", None, ["a", "b"], [{"n": 1}, {"n": 2}])
+        self.assertEqual((2, []), (success, errors))
+        self.cluster.bad_ids = {"b"}
+        success, errors = self.es.batch_update("test", None, iter(["a", "b"]), iter([{"n": 3}, {"n": 4}]))
+        self.assertEqual(1, success)
+        self.assertListEqual([("update", "b", 400)], [(error["op"], error["_id"], error["status"]) for error in errors])
+        self.assertListEqual([("a", {"n": 1}), ("b", {"n": 2}), ("a", {"n": 3})], self.cluster.docs["test"])
+
+
+class TestBackup(unittest.TestCase):
+    def setUp(self):
+        self.docs = [(str(i), {"n": i}) for i in range(5)]
+        self.cluster = Cluster({"src": list(self.docs)})
+        self.es = stub_helper(self.cluster)
+
+    def test_server_side(self):
+        # Another client of the same cluster still copies server-side.
+        self.es.backup("src", "des", stub_helper(self.cluster)._client, poll_interval=0)
+        self.assertListEqual(self.docs, self.cluster.docs["des"])
+        self.assertEqual(0, self.cluster.tasks["node:0"])
+        self.assertListEqual([], self.cluster.bulks)
+        # Relaxed settings are restored.
+        self.assertEqual("1", self.cluster.settings["des"]["number_of_replicas"])
+        self.assertIsNone(self.cluster.settings["des"]["refresh_interval"])
+
+        with self.assertRaises(ValueError):
+            self.es.backup("src", "des", overwrite=False)
+        self.es.backup("src", "des", poll_interval=0)
+        self.assertListEqual(self.docs, self.cluster.docs["des"])
+
+    def test_cross_cluster(self):
+        other = Cluster(dict(), uuid="other")
+        self.es.backup("src", "des", stub_helper(other)._client)
+        self.assertListEqual(self.docs, other.docs["des"])
+        self.assertDictEqual({}, self.cluster.tasks)
+        self.assertEqual(1, len(other.bulks))
+        self.assertEqual("1", other.settings["des"]["number_of_replicas"])
+
+
+class FakeAsyncClient(object):
+    """Stands for AsyncElasticsearch, requests take delay seconds.
+    """
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.closed = False
+        self.active = 0
+        self.max_active = 0
+        self.requests = 0
+
+    async def _request(self, result):
+        if self.closed:
+            raise RuntimeError("Client is closed.")
+        self.requests += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        return result
+
+    async def search(self, index, body):
+        return await self._request({"hits": {"hits": [{"_index": index, "_source": body}]}})
+
+    async def bulk(self, actions):
+        # Items of ids 3 and 7 fail.
+        items = [(action["_id"] not in ("3", "7"), {action.get("_op_type", "index"): {"_id": action["_id"], "status": 400}})
+                 for action in actions]
+        return await self._request(items)
+
+    async def close(self):
+        self.closed = True
+
+
+async def fake_streaming_bulk(client, actions, **kwargs):
+    for ok, item in await client.bulk(actions):
+        yield ok, item
+
+
+class FakeAsyncHelper(AsyncEsHelper):
+    def _connect(self):
+        return FakeAsyncClient()
+
+
+class TestAsyncEsHelper(unittest.TestCase):
+    def setUp(self):
+        self.es = FakeAsyncHelper("http://stub:9200", "user", "password", concurrency=3)
+        self.client = self.es._client
+
+    def test_search_many(self):
+        queries = [{"n": i} for i in range(10)]
+        self.assertListEqual([[query] for query in queries], asyncio.run(self.es.search_many("test", queries)))
+        # Requests beyond concurrency wait for a slot.
+        self.assertEqual(10, self.client.requests)
+        self.assertEqual(3, self.client.max_active)
+
+    def test_reset(self):
+        async def main():
+            searches = asyncio.ensure_future(self.es.search_many("test", [{"n": i} for i in range(5)]))
+            while not self.client.active:
+                await asyncio.sleep(0)
+            await self.es.reset()
+            # Requests in flight finish on the old client, waiting ones go to the new client.
+            self.assertFalse(self.client.closed)
+            self.assertEqual([{"n": 5}], await self.es.search("test", {"n": 5}))
+            self.assertListEqual([[{"n": i}] for i in range(5)], await searches)
+            self.assertTrue(self.client.closed)
+            self.assertFalse(self.es._client.closed)
+            self.assertEqual((3, 3), (self.client.requests, self.es._client.requests))
+            # An idle client is closed at once.
+            client = self.es._client
+            await self.es.reset()
+            self.assertTrue(client.closed)
+
+        asyncio.run(main())
+
+    def test_close(self):
+        async def main():
+            search = asyncio.ensure_future(self.es.search("test", {}))
+            while not self.client.active:
+                await asyncio.sleep(0)
+            await self.es.close()
+            self.assertFalse(self.client.closed)
+            await search
+            self.assertTrue(self.client.closed)
+
+            es = FakeAsyncHelper("http://stub:9200", "user", "password")
+            await es.close()
+            self.assertTrue(es._client.closed)
+
+        asyncio.run(main())
+
+    def test_bulk(self):
+        actions = [{"_index": "test", "_id": str(i), "_source": {}} for i in range(25)]
+        with mock.patch("elasticsearch.helpers.async_streaming_bulk", fake_streaming_bulk, create=True):
+            result = asyncio.run(self.es.bulk(actions, chunk_size=5, concurrency=4))
+            success, errors = asyncio.run(self.es.batch_update("test", None, ["3", "4"], [{}, {}]))
+        self.assertEqual((23, 2), (result["success"], result["failed"]))
+        self.assertListEqual(["3", "7"], sorted(error["_id"] for error in result["errors"]))
+        # 5 chunks and the update, 4 chunks are sent at a time but only 3 get a slot.
+        self.assertEqual(5 + 1, self.client.requests)
+        self.assertEqual(3, self.client.max_active)
+        self.assertEqual(1, success)
+        self.assertListEqual([("update", "3")], [(error["op"], error["_id"]) for error in errors])
@@ -0,0 +1,76 @@
+# coding: utf-8
+import threading
+import unittest
+
+from utils import metrics
+
+
+def run_threads(fn, threads):
+    workers = [threading.Thread(target=fn, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+class TestBuckets(unittest.TestCase):
+    def test_bounds(self):
+        for ns in [0, 1, 7, 8, 9, 100, 12345, 10 ** 9]:
+            lower, upper = metrics.bucket_bounds(metrics.bucket_of(ns))
+            self.assertTrue(lower <= ns < upper)
+            self.assertLessEqual(upper - lower, max(1, lower / 2))
+
+
+class TestTimer(unittest.TestCase):
+    def test_snapshot(self):
+        timer = metrics.Timer("test")
+        for ns in range(1, 101):
+            timer.record(ns * 1000)
+        snapshot = timer.snapshot()
+        self.assertEqual(100, snapshot["count"])
+        self.assertAlmostEqual(5050e-6, snapshot["total_seconds"])
+        self.assertEqual(100000, snapshot["max_ns"])
+        self.assertLess(abs(snapshot["p50_ns"] - 50000) / 50000, 0.25)
+        self.assertLess(abs(snapshot["p99_ns"] - 99000) / 99000, 0.25)
+        timer.reset()
+        self.assertDictEqual({"count": 0, "total_seconds": 0.0}, timer.snapshot())
+
+    def test_dead_threads(self):
+        timer = metrics.Timer("test")
+        for _ in range(10):
+            run_threads(lambda i: timer.record(10), 10)
+        self.assertEqual(100, timer.snapshot()["count"])
+        self.assertEqual(1, len(timer._sharded.shards()))
+
+
+class TestCounter(unittest.TestCase):
+    def test_maxkeys(self):
+        counter = metrics.Counter("test", maxkeys=2)
+        for key in ["a", "b", "a", "c", "d"]:
+            counter.add(key)
+        self.assertDictEqual({"a": 2, "b": 1, metrics.OTHER_KEY: 2}, counter.snapshot())
+
+    def test_dead_threads(self):
+        counter = metrics.Counter("test", maxkeys=3)
+        run_threads(lambda i: counter.add(i % 5), 20)
+        self.assertEqual(1, len(counter._sharded.shards()))
+        counts = counter.snapshot()
+        self.assertEqual(20, sum(counts.values()))
+        self.assertLessEqual(len(counts), 4)
+
+
+class TestRegistry(unittest.TestCase):
+    def test_snapshot(self):
+        registry = metrics.Registry()
+        timer = metrics.Timer("a")
+        counter = metrics.Counter("a")
+        registry.add(timer)
+        registry.add(counter)
+        timer.record(5)
+        counter.add("x")
+        snapshot = registry.snapshot(reset=True)
+        self.assertListEqual(["a", "a#2"], sorted(snapshot))
+        self.assertEqual(0, timer.snapshot()["count"])
+        self.assertDictEqual({}, counter.snapshot())
+        del timer, counter, snapshot
+        self.assertListEqual([], registry.metrics())
@@ -0,0 +1,113 @@
+# coding: utf-8
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from utils import multiprocess
+from utils.multiprocess import merge_file, scheduler_chunks
+
+
+def write_square(fout, x):
+    if x == 37:
+        raise ValueError(x)
+    fout.write("{}\n".format(x * x))
+
+
+class TestMergeFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pattern = os.path.join(self.dir, "split.%d")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def split(self, *contents):
+        for i, content in enumerate(contents):
+            with open(self.pattern % i, "wb") as fout:
+                fout.write(content)
+
+    def test_plain_file(self):
+        path = os.path.join(self.dir, "out")
+        with open(path, "wb") as fout:
+            fout.write(b"head\n")
+            self.split(b"a\nb\n", b"", b"c", "中\n".encode("utf-8"))
+            merge_file(4, self.pattern, fout)
+            fout.write(b"tail\n")
+        with open(path, "rb") as fin:
+            self.assertEqual("head\na\nb\nc\n中\ntail\n".encode("utf-8"), fin.read())
+        self.assertFalse(os.path.exists(self.pattern % 0))
+
+    def test_plain_copy(self):
+        # Without kernel copies, files are copied in blocks.
+        copy_fd = multiprocess._copy_fd
+        multiprocess._copy_fd = lambda fin, out_fd, size: False
+        try:
+            self.test_plain_file()
+        finally:
+            multiprocess._copy_fd = copy_fd
+
+    def test_text_and_gzip(self):
+        self.split(b"a\n", b"b")
+        fout = io.StringIO()
+        merge_file(2, self.pattern, fout)
+        self.assertEqual("a\nb\n", fout.getvalue())
+
+        path = os.path.join(self.dir, "out.gz")
+        self.split(b"a\n", b"b")
+        with gzip.open(path, "wb") as fout:
+            merge_file(2, self.pattern, fout)
+        with gzip.open(path, "rb") as fin:
+            self.assertEqual(b"a\nb\n", fin.read())
+
+    def test_encoding(self):
+        path = os.path.join(self.dir, "out")
+        for encoding in ("utf-8", "gbk"):
+            with open(path, "w", encoding=encoding) as fout:
+                fout.write("头\n")
+                self.split("中\n".encode("utf-8"), "文".encode("utf-8"))
+                merge_file(2, self.pattern, fout)
+                fout.write("尾\n")
+            with open(path, "rb") as fin:
+                self.assertEqual("头\n中\n文\n尾\n".encode(encoding), fin.read())
+
+    def test_background(self):
+        self.split(b"a\n", b"b\n")
+        fout = io.BytesIO()
+        merge_file(2, self.pattern, fout, background=True).join()
+        self.assertEqual(b"a\nb\n", fout.getvalue())
+
+        self.split(b"a\n")
+        thread = merge_file(2, self.pattern, io.BytesIO(), background=True)
+        with self.assertRaises(FileNotFoundError):
+            thread.join()
+
+
+class TestSchedulerChunks(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pattern = os.path.join(self.dir, "split.%d")
+        self.path = os.path.join(self.dir, "out")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_ordered(self):
+        for processes in (False, True):
+            with open(self.path, "w", encoding="utf-8") as fout:
+                scheduler_chunks(write_square, [(i,) for i in range(30)], 3, self.pattern, fout,
+                                 processes=processes, chunksize=4)
+            with open(self.path, encoding="utf-8") as fin:
+                self.assertEqual("".join("{}\n".format(i * i) for i in range(30)), fin.read())
+            self.assertListEqual(["out"], os.listdir(self.dir))
+
+    def test_error(self):
+        for processes in (False, True):
+            with open(self.path, "w", encoding="utf-8") as fout:
+                with self.assertRaises(ValueError):
+                    scheduler_chunks(write_square, [(i,) for i in range(60)], 3, self.pattern, fout,
+                                     processes=processes, chunksize=4)
+            # Split files are removed.
+            self.assertListEqual(["out"], os.listdir(self.dir))